@@ -9,6 +9,7 @@ import requests
 import json
 import logging
 import random
+from collections import deque
 from abc import ABC, abstractmethod
 
 # Set up logging
@@ -29,7 +30,7 @@ class PokemonAI(ABC):
         self.name = name
         self.game_state = {}
         self.screen_state = None
-        self.previous_actions = []
+        self.previous_actions = deque(maxlen=20)  # Only the last 20 actions are kept
         self.current_role = "player"  # "player" or "pokemon"
     
     @abstractmethod
@@ -56,9 +57,6 @@ class PokemonAI(ABC):
     def record_action(self, action):
         """Record an action taken by the AI."""
         self.previous_actions.append(action)
-        # Keep only the last 20 actions
-        if len(self.previous_actions) > 20:
-            self.previous_actions.pop(0)
     
     def set_role(self, role):
         """Set the current role of the AI."""
@@ -168,13 +166,13 @@ class ClaudeAI(PokemonAI):
         # Choose starter Pokémon (Claude prefers Bulbasaur)
         if "BULBASAUR" not in str(self.game_state) and len(self.previous_actions) < 15:
             # Navigate to Bulbasaur
-            if "right" not in self.previous_actions[-3:] if self.previous_actions else True:
+            if "right" not in list(self.previous_actions)[-3:] if self.previous_actions else True:
                 return "left", "I think Bulbasaur is an excellent strategic choice for the early gyms."
             else:
                 return "a", "Bulbasaur is my choice - great for the first two gyms!"
         
         # More methodical exploration than Grok
-        recent_moves = self.previous_actions[-5:] if self.previous_actions else []
+        recent_moves = list(self.previous_actions)[-5:] if self.previous_actions else []
         
         # Avoid backtracking immediately
         if recent_moves and recent_moves[-1] == "up":
@@ -6,11 +6,37 @@ and returns appropriate action using screen-specific prompts.
 """
 
 from http.server import BaseHTTPRequestHandler
+from collections import OrderedDict
 import os
 import json
 import re
-import urllib.request
-import urllib.error
+import logging
+import io
+import time
+import base64
+import hashlib
+import threading
+import http.client
+
+logger = logging.getLogger(__name__)
+
+# orjson is optional - it is much faster on the large base64 payloads.
+# Both loads functions raise a json.JSONDecodeError subclass on bad input.
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+    _loads = json.loads
+
+# Pillow is optional - without it screenshots are forwarded as-is
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
 
 # Import game state utilities
 try:
@@ -18,6 +44,458 @@ try:
 except ImportError:
     from game_state import GameState, load_prompt, build_user_message
 
+# Helpers shared with api/index.py
+try:
+    from .shared import InFlightRequests, JsonObjectScanner, dhash_image
+except ImportError:
+    from shared import InFlightRequests, JsonObjectScanner, dhash_image
+
+
+# Fixed system preamble, sent as its own leading message so xAI's automatic
+# prompt caching sees a byte-identical prefix on every request. Keep it free
+# of per-request values.
+_STABLE_SYSTEM_PREAMBLE = """You are playing Pokemon Red/Blue/Yellow. Analyze the screenshot and choose an action.
+
+CONTROLS: a, b, up, down, left, right, start, select
+OUTPUT: JSON only, exactly these keys - {"action": "<button>", "commentary": "<one short sentence: what you see and why>", "confidence": <0.0-1.0>}"""
+
+# xAI endpoint
+XAI_HOST = "api.x.ai"
+XAI_CHAT_PATH = "/v1/chat/completions"
+XAI_TIMEOUT = 12
+MAX_IDLE_CONNECTIONS = 4
+
+# Decoder used to pull a JSON object out of free-form model output
+_JSON_DECODER = json.JSONDecoder()
+
+# Answer trivially-decidable screens locally instead of calling xAI
+LOCAL_POLICY_ENABLED = os.getenv('LOCAL_POLICY_ENABLED', '1').strip().lower() not in ('0', 'false', 'no')
+
+# Native Game Boy resolution
+SCREEN_SIZE = (160, 144)
+
+# Response cache settings
+CACHE_MAX_ENTRIES = 256
+CACHE_TTL_MS = int(os.getenv('ACTION_CACHE_TTL_MS', '30000'))
+CACHE_DISK_DIR = os.path.join('/tmp', 'grok-plays-pokemon-cache')
+PHASH_MAX_DISTANCE = 4  # Max differing dHash bits for a near-duplicate frame
+
+
+class ResponseCache:
+    """
+    TTL + LRU cache of AI responses.
+
+    Entries live in memory first; a copy is also written to /tmp so warm
+    serverless invocations that land on a fresh instance can still hit.
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl_ms: int = CACHE_TTL_MS,
+                 disk_dir: str | None = CACHE_DISK_DIR):
+        self.max_entries = max_entries
+        self.ttl_ms = ttl_ms
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict()
+
+    def get(self, key: str) -> dict | None:
+        """Return the cached result for key, or None if missing or expired."""
+        entry = self._entries.get(key)
+        now = time.monotonic()
+        if entry is not None:
+            created_at, ttl_ms, result = entry
+            if (now - created_at) * 1000 < ttl_ms:
+                self._entries.move_to_end(key)
+                return result
+            del self._entries[key]
+
+        result = self._disk_get(key)
+        if result is not None:
+            self._store(key, result, self.ttl_ms, now)
+        return result
+
+    def set(self, key: str, result: dict, ttl_ms: int | None = None):
+        """Store a result under key."""
+        ttl_ms = self.ttl_ms if ttl_ms is None else ttl_ms
+        if ttl_ms <= 0:
+            return
+        self._store(key, result, ttl_ms, time.monotonic())
+        self._disk_set(key, result)
+
+    def clear(self):
+        """Drop all in-memory entries."""
+        self._entries.clear()
+
+    def _store(self, key, result, ttl_ms, created_at):
+        self._entries[key] = (created_at, ttl_ms, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _disk_get(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            if (time.time() - os.path.getmtime(path)) * 1000 >= self.ttl_ms:
+                return None
+            with open(path, 'rb') as f:
+                return _loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def _disk_set(self, key, result):
+        if not self.disk_dir:
+            return
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            with open(self._disk_path(key), 'wb') as f:
+                f.write(_dumps(result))
+        except OSError:
+            pass
+
+
+_response_cache = ResponseCache()
+
+
+# Requests currently waiting on xAI, keyed by response cache key
+_inflight = InFlightRequests()
+
+
+class XAIHTTPError(Exception):
+    """Non-2xx response from the xAI API."""
+
+    def __init__(self, code: int, body: str = ""):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+        self.body = body
+
+
+# Keep-alive connections to xAI, reused across warm invocations so only the
+# first request on an instance pays the TCP + TLS handshake
+_idle_connections = []
+
+
+def _open_xai_response(api_key: str, body: bytes):
+    """
+    Send a chat completion request over a pooled keep-alive connection.
+
+    Returns (connection, response) with the response body still unread.
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}",
+        "User-Agent": "GrokPlaysPokemon/2.0",
+        "Accept": "text/event-stream, application/json",
+        "Connection": "keep-alive",
+    }
+
+    while True:
+        try:
+            conn = _idle_connections.pop()
+            reused = True
+        except IndexError:
+            conn = http.client.HTTPSConnection(XAI_HOST, timeout=XAI_TIMEOUT)
+            reused = False
+
+        try:
+            conn.request("POST", XAI_CHAT_PATH, body=body, headers=headers)
+            return conn, conn.getresponse()
+        except TimeoutError:
+            conn.close()
+            raise
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            if reused:
+                # The server dropped an idle keep-alive connection - try again
+                continue
+            raise
+
+
+def prewarm_xai_connection():
+    """
+    Start connecting to xAI in the background if no idle connection is pooled.
+
+    Called on request entry so the TCP + TLS handshake overlaps with reading
+    the body, normalizing the screenshot and building the prompt.
+    """
+    if _idle_connections:
+        return
+
+    def connect():
+        conn = http.client.HTTPSConnection(XAI_HOST, timeout=XAI_TIMEOUT)
+        try:
+            conn.connect()
+        except OSError:
+            conn.close()
+            return
+        if len(_idle_connections) < MAX_IDLE_CONNECTIONS:
+            _idle_connections.append(conn)
+        else:
+            conn.close()
+
+    threading.Thread(target=connect, daemon=True).start()
+
+
+def _release_connection(conn, response):
+    """Return a fully-read connection to the pool, or close it."""
+    if response.will_close or len(_idle_connections) >= MAX_IDLE_CONNECTIONS:
+        conn.close()
+    else:
+        _idle_connections.append(conn)
+
+
+def complete_with_xai(api_key: str, body: bytes) -> str:
+    """
+    Run a chat completion and return the assistant's message text.
+
+    The request is sent with stream=True; reading stops as soon as the first
+    JSON object in the output is complete, so trailing tokens are never
+    waited for. Falls back to a normal JSON body if the server doesn't stream.
+    Raises XAIHTTPError for non-2xx responses.
+    """
+    conn, response = _open_xai_response(api_key, body)
+
+    if response.status >= 400:
+        data = response.read()
+        _release_connection(conn, response)
+        raise XAIHTTPError(response.status, data.decode('utf-8', 'replace'))
+
+    if 'text/event-stream' not in response.getheader('Content-Type', ''):
+        data = response.read()
+        _release_connection(conn, response)
+        return _loads(data)['choices'][0]['message']['content']
+
+    parts = []
+    scanner = JsonObjectScanner()
+    finished = False
+    try:
+        while True:
+            line = response.readline()
+            if not line:
+                finished = True
+                break
+            line = line.strip()
+            if not line.startswith(b'data:'):
+                continue
+            chunk = line[5:].strip()
+            if chunk == b'[DONE]':
+                response.read()
+                finished = True
+                break
+
+            delta = _loads(chunk)['choices'][0].get('delta', {}).get('content') or ''
+            parts.append(delta)
+            if scanner.feed(delta):
+                break
+    finally:
+        if finished:
+            _release_connection(conn, response)
+        else:
+            # Abandoning the stream mid-body - the socket can't be reused
+            conn.close()
+
+    return ''.join(parts)
+
+
+def normalize_screenshot(image_base64: str) -> str:
+    """
+    Shrink an upscaled canvas capture back to native Game Boy size.
+
+    The frontend sends whatever size its canvas is (often 2-4x), which only
+    inflates vision tokens and upload bytes. Returns the original string if
+    Pillow is missing, the image is already small, or decoding fails.
+    """
+    if not PIL_AVAILABLE or not image_base64:
+        return image_base64
+
+    try:
+        img = Image.open(io.BytesIO(base64.b64decode(image_base64)))
+        if img.width <= SCREEN_SIZE[0] and img.height <= SCREEN_SIZE[1]:
+            return image_base64
+
+        img = img.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=16)
+        img = img.resize(SCREEN_SIZE, Image.NEAREST)
+
+        buf = io.BytesIO()
+        img.save(buf, format='PNG', optimize=True)
+        return base64.b64encode(buf.getvalue()).decode('ascii')
+    except Exception:
+        return image_base64
+
+
+def make_context_key(game_state: GameState) -> str:
+    """Hash the non-image parts of a request that affect the AI's answer."""
+    parts = [
+        game_state.screen_type,
+        (game_state.ocr_text or '')[:500],
+        ','.join(map(str, game_state.recent_actions[-5:])),
+    ]
+    return hashlib.sha256("|".join(parts).encode('utf-8')).hexdigest()
+
+
+def make_cache_key(image_base64: str, context_key: str) -> str:
+    """Build the response cache key for a screenshot and its context key."""
+    image_hash = hashlib.sha256(image_base64.encode('ascii', 'ignore')).hexdigest()
+    return hashlib.sha256(f"{context_key}|{image_hash}".encode('ascii')).hexdigest()
+
+
+def screenshot_dhash(image_base64: str) -> int | None:
+    """
+    64-bit difference hash of a screenshot, or None without Pillow.
+
+    Frames that differ only by a few pixels (animated tiles, blinking
+    cursors) hash to the same or a nearby value.
+    """
+    if not PIL_AVAILABLE or not image_base64:
+        return None
+
+    try:
+        return dhash_image(Image.open(io.BytesIO(base64.b64decode(image_base64))))
+    except Exception:
+        return None
+
+
+class PerceptualCache:
+    """
+    Small TTL cache of AI responses matched by screenshot dHash distance.
+
+    Backs up the exact-match ResponseCache for frames that jitter between
+    polls. Entries only match within the same context key, so the same
+    picture with different OCR text or recent actions is a miss.
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl_ms: int = CACHE_TTL_MS,
+                 max_distance: int = PHASH_MAX_DISTANCE):
+        self.max_entries = max_entries
+        self.ttl_ms = ttl_ms
+        self.max_distance = max_distance
+        self._entries = OrderedDict()
+
+    def get(self, context_key: str, dhash: int) -> dict | None:
+        """Return a cached result for a visually similar frame, if any."""
+        now = time.monotonic()
+        for key, (created_at, entry_context, entry_hash, result) in list(self._entries.items()):
+            if (now - created_at) * 1000 >= self.ttl_ms:
+                del self._entries[key]
+                continue
+            if entry_context == context_key and (entry_hash ^ dhash).bit_count() <= self.max_distance:
+                self._entries.move_to_end(key)
+                return result
+        return None
+
+    def set(self, context_key: str, dhash: int, result: dict):
+        """Store a result for a frame."""
+        if self.ttl_ms <= 0:
+            return
+        key = (context_key, dhash)
+        self._entries[key] = (time.monotonic(), context_key, dhash, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+_perceptual_cache = PerceptualCache()
+
+
+def fast_policy(game_state: GameState) -> dict | None:
+    """
+    Decide obvious screens without the model.
+
+    Returns an action dict, or None when the screen needs real analysis.
+    """
+    stuck = game_state.detect_stuck_pattern()
+
+    if game_state.screen_type == 'title' and game_state.screen_confidence > 0.9:
+        # Already mashed START without progress - let the model look
+        if not stuck:
+            return {
+                "action": "start",
+                "commentary": "Title screen (local policy)",
+                "confidence": 0.95,
+                "screen_type": game_state.screen_type,
+                "local_policy": True
+            }
+
+    if (game_state.screen_type == 'dialog' and stuck
+            and stuck['pattern'] == 'same_action_repeated' and stuck['action'] == 'a'):
+        return {
+            "action": "b",
+            "commentary": "Dialog not advancing with A - trying B (local policy)",
+            "confidence": 0.5,
+            "screen_type": game_state.screen_type,
+            "local_policy": True
+        }
+
+    return None
+
+
+_USER_MESSAGE_PLACEHOLDER = "__USER_MESSAGE__"
+_BASE64_RE = re.compile(r'[A-Za-z0-9+/]*={0,2}')
+_IMAGE_PLACEHOLDER = "__IMAGE_BASE64__"
+
+# Serialized request bodies per screen type, split around the user message
+# and image so only those two values are encoded per request
+_payload_templates = {}
+
+
+def _build_payload_template(screen_type: str):
+    """JSON-encode the request payload once, with placeholders for per-request values."""
+    payload = {
+        "model": "grok-2-vision-latest",
+        # Stable preamble first, then the per-screen prompt, with the image
+        # last so it never breaks the cached prefix
+        "messages": [
+            {"role": "system", "content": _STABLE_SYSTEM_PREAMBLE},
+            {"role": "system", "content": load_prompt(screen_type)},
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": _USER_MESSAGE_PLACEHOLDER},
+                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{_IMAGE_PLACEHOLDER}", "detail": "low"}}
+                ]
+            }
+        ],
+        # The reply is a single small JSON object - JSON mode keeps the model
+        # from wrapping it in prose, and the budget leaves room for a
+        # one-sentence commentary without truncating the object
+        "max_tokens": 80,
+        "response_format": {"type": "json_object"},
+        "temperature": 0.1,  # Lower temperature for more consistent responses
+        "stream": True
+    }
+    encoded = _dumps(payload)
+    head, rest = encoded.split(_USER_MESSAGE_PLACEHOLDER.encode(), 1)
+    mid, tail = rest.split(_IMAGE_PLACEHOLDER.encode(), 1)
+    return head, mid, tail
+
+
+def build_payload_body(screen_type: str, user_message: str, image_base64: str) -> bytes:
+    """Build the serialized chat completion request for a screen."""
+    if screen_type not in GameState.SCREEN_TYPES:
+        screen_type = 'unknown'
+
+    template = _payload_templates.get(screen_type)
+    if template is None:
+        template = _payload_templates[screen_type] = _build_payload_template(screen_type)
+
+    head, mid, tail = template
+    # Plain base64 never needs JSON escaping, so it is spliced in as-is;
+    # anything else from the client goes through the encoder
+    if _BASE64_RE.fullmatch(image_base64):
+        image_bytes = image_base64.encode('ascii')
+    else:
+        image_bytes = _dumps(image_base64)[1:-1]
+
+    return b"".join((
+        head,
+        _dumps(user_message)[1:-1],
+        mid,
+        image_bytes,
+        tail,
+    ))
+
 
 def get_game_action(api_key: str, image_base64: str, game_state: GameState) -> dict:
     """
@@ -39,73 +517,62 @@ def get_game_action(api_key: str, image_base64: str, game_state: GameState) -> d
         game_state.screen_type = 'unknown'
         game_state.screen_confidence = 0.0
 
-    # Load the appropriate prompt for this screen type
-    screen_prompt = load_prompt(game_state.screen_type)
-
-    # Build compact system prompt
-    system_prompt = f"""You are playing Pokemon Red/Blue/Yellow. Analyze the screenshot and choose an action.
-
-{screen_prompt}
-
-CONTROLS: a, b, up, down, left, right, start, select
-OUTPUT: JSON only - {{"action": "<button>", "commentary": "<what you see and why>", "confidence": <0.0-1.0>}}"""
-
+    if LOCAL_POLICY_ENABLED:
+        local = fast_policy(game_state)
+        if local is not None:
+            return local
+
+    # Identical screen + context seen recently: reuse the previous answer
+    context_key = make_context_key(game_state)
+    cache_key = make_cache_key(image_base64, context_key)
+    cached = _response_cache.get(cache_key)
+    if cached is not None:
+        return {**cached, "cached": True}
+
+    # Near-identical frame in the same context: also reuse
+    dhash = screenshot_dhash(image_base64)
+    if dhash is not None:
+        cached = _perceptual_cache.get(context_key, dhash)
+        if cached is not None:
+            return {**cached, "cached": True}
+
+    def fetch():
+        result = _request_game_action(api_key, image_base64, game_state)
+
+        # Never cache transient failures - the next poll should retry for real
+        if not result.get("retry"):
+            _response_cache.set(cache_key, result)
+            if dhash is not None:
+                _perceptual_cache.set(context_key, dhash, result)
+        return result
+
+    # Coalesce concurrent identical requests into a single xAI call
+    result = _inflight.run(cache_key, fetch, XAI_TIMEOUT + 1)
+    if result is None:
+        return {"action": "wait", "commentary": "Waiting on duplicate request", "confidence": 0.0, "retry": True}
+    return result
+
+
+def _request_game_action(api_key: str, image_base64: str, game_state: GameState) -> dict:
+    """Call xAI for an action and validate the response."""
     # Build user message with context
     user_message = build_user_message(game_state)
 
     try:
-        # Build request payload - much smaller than before
-        payload = {
-            "model": "grok-2-vision-latest",
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": user_message},
-                        {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_base64}", "detail": "high"}}
-                    ]
-                }
-            ],
-            "max_tokens": 150,
-            "temperature": 0.1  # Lower temperature for more consistent responses
-        }
-
-        # Make API request
-        req = urllib.request.Request(
-            "https://api.x.ai/v1/chat/completions",
-            data=json.dumps(payload).encode('utf-8'),
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}",
-                "User-Agent": "GrokPlaysPokemon/2.0",
-                "Accept": "application/json"
-            }
-        )
-
-        with urllib.request.urlopen(req, timeout=12) as response:
-            result = json.loads(response.read().decode('utf-8'))
+        body = build_payload_body(game_state.screen_type, user_message, image_base64)
+        text = complete_with_xai(api_key, body).strip()
 
-        text = result['choices'][0]['message']['content'].strip()
-
-        # Parse JSON response
+        # JSON mode should make this the whole response; raw_decode from the
+        # first brace is kept as a last resort for stray prose
         data = None
-        if text.startswith('{'):
+        start = text.find('{')
+        if start >= 0:
             try:
-                data = json.loads(text)
+                data, _ = _JSON_DECODER.raw_decode(text, start)
             except json.JSONDecodeError:
                 pass
 
-        if not data:
-            # Try to extract JSON from response
-            match = re.search(r'\{[^{}]+\}', text)
-            if match:
-                try:
-                    data = json.loads(match.group())
-                except json.JSONDecodeError:
-                    pass
-
-        if not data:
+        if not isinstance(data, dict) or not data:
             return {
                 "action": "wait",
                 "commentary": "Could not parse AI response",
@@ -120,8 +587,7 @@ OUTPUT: JSON only - {{"action": "<button>", "commentary": "<what you see and why
         confidence = float(data.get("confidence", 0.5))
 
         # Validate action
-        valid_actions = ["a", "b", "up", "down", "left", "right", "start", "select", "wait"]
-        if action not in valid_actions:
+        if action not in GameState.VALID_ACTIONS:
             return {
                 "action": "wait",
                 "commentary": f"Invalid action '{action}' returned",
@@ -169,13 +635,8 @@ OUTPUT: JSON only - {{"action": "<button>", "commentary": "<what you see and why
             "screen_type": game_state.screen_type
         }
 
-    except urllib.error.HTTPError as e:
-        error_body = ""
-        try:
-            error_body = e.read().decode('utf-8')
-        except:
-            pass
-        print(f"xAI HTTP Error: {e.code} - {error_body}")
+    except XAIHTTPError as e:
+        logger.warning("xAI HTTP Error: %s - %s", e.code, e.body)
 
         if e.code == 429:
             return {"action": "wait", "commentary": "Rate limited - waiting", "confidence": 0.0, "retry": True}
@@ -183,19 +644,38 @@ OUTPUT: JSON only - {{"action": "<button>", "commentary": "<what you see and why
             return {"action": "wait", "commentary": "Server error - waiting", "confidence": 0.0, "retry": True}
         return {"action": "wait", "commentary": f"API Error {e.code}", "confidence": 0.0, "retry": True}
 
-    except urllib.error.URLError as e:
-        print(f"xAI URL Error: {e.reason}")
+    except (OSError, http.client.HTTPException) as e:
+        logger.warning("xAI Connection Error: %s", e)
         return {"action": "wait", "commentary": "Connection error", "confidence": 0.0, "retry": True}
 
     except json.JSONDecodeError:
         return {"action": "wait", "commentary": "JSON parse error", "confidence": 0.0, "retry": True}
 
     except Exception as e:
-        import traceback
-        print(f"Error: {traceback.format_exc()}")
+        logger.error("Error getting game action: %s", e)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Traceback:", exc_info=True)
         return {"action": "wait", "commentary": f"Error: {str(e)[:50]}", "confidence": 0.0, "retry": True}
 
 
+# Screen keywords in priority order - the first class listed wins when the
+# commentary mentions several
+_SCREEN_KEYWORDS = (
+    ('title', ('title screen', 'press start', 'pokemon logo')),
+    ('dialog', ('dialog', 'dialogue', 'text box', 'talking', 'speaking')),
+    ('battle', ('battle', 'fighting', 'hp bar', 'attack', 'fight menu')),
+    ('menu', ('menu', 'pokemon menu', 'item menu', 'save', 'option')),
+    ('overworld', ('overworld', 'walking', 'route', 'town', 'city')),
+    ('name_entry', ('name entry', 'naming', 'letter grid', 'keyboard')),
+)
+_MOVE_SELECT_KEYWORDS = ('select', 'choosing')
+_SCREEN_PRIORITY = {screen: i for i, (screen, _) in enumerate(_SCREEN_KEYWORDS)}
+_SCREEN_RE = re.compile('|'.join(
+    f"(?P<{screen}>{'|'.join(re.escape(w) for w in sorted(words, key=len, reverse=True))})"
+    for screen, words in _SCREEN_KEYWORDS
+))
+
+
 def detect_screen_from_commentary(commentary: str) -> str | None:
     """
     Try to detect what screen type the AI thinks it's looking at from its commentary.
@@ -207,26 +687,22 @@ def detect_screen_from_commentary(commentary: str) -> str | None:
 
     commentary_lower = commentary.lower()
 
-    # Look for screen type keywords
-    if any(word in commentary_lower for word in ['title screen', 'press start', 'pokemon logo']):
-        return 'title'
-
-    if any(word in commentary_lower for word in ['dialog', 'dialogue', 'text box', 'talking', 'speaking']):
-        return 'dialog'
-
-    if any(word in commentary_lower for word in ['battle', 'fighting', 'hp bar', 'attack', 'fight menu']):
-        if 'move' in commentary_lower and ('select' in commentary_lower or 'choosing' in commentary_lower):
+    # Single pass over the commentary, keeping the highest-priority match
+    best = None
+    for match in _SCREEN_RE.finditer(commentary_lower):
+        screen = match.lastgroup
+        if best is None or _SCREEN_PRIORITY[screen] < _SCREEN_PRIORITY[best]:
+            best = screen
+            if best == 'title':
+                break
+
+    if best == 'battle':
+        if 'move' in commentary_lower and any(w in commentary_lower for w in _MOVE_SELECT_KEYWORDS):
             return 'battle_move_select'
         return 'battle'
 
-    if any(word in commentary_lower for word in ['menu', 'pokemon menu', 'item menu', 'save', 'option']):
-        return 'menu'
-
-    if any(word in commentary_lower for word in ['overworld', 'walking', 'route', 'town', 'city']):
-        return 'overworld'
-
-    if any(word in commentary_lower for word in ['name entry', 'naming', 'letter grid', 'keyboard']):
-        return 'name_entry'
+    if best is not None:
+        return best
 
     if 'yes' in commentary_lower and 'no' in commentary_lower:
         return 'yes_no'
@@ -234,6 +710,41 @@ def detect_screen_from_commentary(commentary: str) -> str | None:
     return None
 
 
+def handle_action_request(api_key: str, data: dict) -> dict:
+    """
+    Turn a decoded /api/action request body into a response dict.
+
+    Independent of the HTTP transport - the handler below only parses and
+    writes bytes around this.
+    """
+    # Extract data
+    screenshot = data.get('screenshot', '')
+    if not screenshot:
+        return {
+            "action": "wait",
+            "commentary": "No screenshot provided",
+            "confidence": 0.0,
+            "retry": True
+        }
+
+    # Build game state from frontend preprocessing
+    state_data = {
+        'screen_type': data.get('screen_type', 'unknown'),
+        'screen_confidence': data.get('screen_confidence', 0.0),
+        'ocr_text': data.get('ocr_text', ''),
+        'recent_actions': data.get('recent_actions', []),
+        'location': data.get('location', 'Unknown'),
+        'badges': data.get('badges', 0),
+        'pokemon_team': data.get('pokemon_team', []),
+    }
+
+    game_state = GameState(state_data)
+    screenshot = normalize_screenshot(screenshot)
+
+    # Get AI action
+    return get_game_action(api_key, screenshot, game_state)
+
+
 class handler(BaseHTTPRequestHandler):
     def do_OPTIONS(self):
         self.send_response(200)
@@ -255,43 +766,21 @@ class handler(BaseHTTPRequestHandler):
             })
             return
 
+        # Handshake with xAI while the request is being preprocessed
+        prewarm_xai_connection()
+
         # Parse request body
         content_length = int(self.headers.get('Content-Length', 0))
         body = self.rfile.read(content_length)
 
         try:
-            data = json.loads(body) if body else {}
+            data = _loads(body) if body else {}
         except json.JSONDecodeError:
             data = {}
+        if not isinstance(data, dict):
+            data = {}
 
-        # Extract data
-        screenshot = data.get('screenshot', '')
-        if not screenshot:
-            self._send_json_response({
-                "action": "wait",
-                "commentary": "No screenshot provided",
-                "confidence": 0.0,
-                "retry": True
-            })
-            return
-
-        # Build game state from frontend preprocessing
-        state_data = {
-            'screen_type': data.get('screen_type', 'unknown'),
-            'screen_confidence': data.get('screen_confidence', 0.0),
-            'ocr_text': data.get('ocr_text', ''),
-            'recent_actions': data.get('recent_actions', []),
-            'location': data.get('location', 'Unknown'),
-            'badges': data.get('badges', 0),
-            'pokemon_team': data.get('pokemon_team', []),
-        }
-
-        game_state = GameState(state_data)
-
-        # Get AI action
-        result = get_game_action(api_key, screenshot, game_state)
-
-        self._send_json_response(result)
+        self._send_json_response(handle_action_request(api_key, data))
 
     def _send_json_response(self, data: dict):
         """Send JSON response with CORS headers."""
@@ -299,4 +788,4 @@ class handler(BaseHTTPRequestHandler):
         self.send_header('Content-Type', 'application/json')
         self.send_header('Access-Control-Allow-Origin', '*')
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(_dumps(data))
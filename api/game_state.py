@@ -5,34 +5,83 @@ Handles tracking of game progress, recent actions, and screen state validation.
 Since this runs on Vercel serverless, state is passed from frontend on each request.
 """
 
+import os
+import re
 import json
+from types import MappingProxyType
 from typing import Dict, List, Optional, Any
 
 
+# OCR keywords recognised by GameState.get_context_hints. Patterns are
+# zero-width lookaheads so keywords whose matches overlap in the OCR text
+# are all reported from a single pass.
+_HINT_KEYWORDS = {
+    'PROF': 'PROF', 'OAK': 'OAK',
+    'YES': 'YES', 'NO': 'NO',
+    'FIGHT': 'FIGHT',
+    'PALLET': 'PALLET', 'VIRIDIAN': 'VIRIDIAN', 'PEWTER': 'PEWTER', 'CERULEAN': 'CERULEAN',
+    'POISON': 'POISON', 'BURN': 'BURN', 'SLEEP': 'SLEEP',
+    'LEARNED': 'LEARNED',
+    'LEVEL': 'LEVEL', 'UP': 'UP',
+    'NICKNAME': 'NICKNAME',
+    # Whole word only - a bare substring matches half the dictionary
+    'END': r'\bEN?D\b',
+}
+_HINT_KEYWORD_RE = re.compile('|'.join(
+    f"(?=(?P<{name}>{pattern}))" for name, pattern in _HINT_KEYWORDS.items()
+))
+
+# (keyword groups that must all be present - any one keyword per group, hint)
+_HINT_RULES = (
+    ((('PROF', 'OAK'),), 'Prof Oak is speaking - press A to advance dialog'),
+    ((('YES',), ('NO',)), 'Yes/No choice detected - use up/down to select, A to confirm'),
+    ((('FIGHT',),), 'Battle menu visible - FIGHT is usually top-left'),
+    ((('PALLET', 'VIRIDIAN', 'PEWTER', 'CERULEAN'),), 'Town/city name detected - in overworld or reading sign'),
+    ((('POISON', 'BURN', 'SLEEP'),), 'Status condition mentioned - may need to heal'),
+    ((('LEARNED',),), 'Pokemon learned a move - press A to continue'),
+    ((('LEVEL',), ('UP',)), 'Level up - press A to continue'),
+    ((('NICKNAME',),), 'Nickname prompt - select NO for faster gameplay'),
+    ((('END',),), 'Name entry END button detected - navigate there to confirm'),
+)
+
+
+# Suggestions for breaking out of a repeated single action
+_STUCK_SUGGESTIONS = {
+    'a': 'Try moving with arrows or press B',
+    'b': 'Try A to confirm or arrows to navigate',
+    'start': 'This might be a dialog - try A instead',
+    'select': 'Try A or START instead',
+    'up': 'Try A to interact or a different direction',
+    'down': 'Try A to interact or a different direction',
+    'left': 'Try A to interact or a different direction',
+    'right': 'Try A to interact or a different direction',
+}
+
+
 class GameState:
     """Manages game state validation and tracking."""
 
     # Valid screen types
-    SCREEN_TYPES = {
+    SCREEN_TYPES = frozenset({
         'title', 'dialog', 'battle', 'battle_move_select', 'menu',
         'overworld', 'name_entry', 'yes_no', 'loading', 'unknown'
-    }
+    })
 
     # Valid actions
-    VALID_ACTIONS = {'a', 'b', 'up', 'down', 'left', 'right', 'start', 'select', 'wait'}
+    VALID_ACTIONS = frozenset({'a', 'b', 'up', 'down', 'left', 'right', 'start', 'select', 'wait'})
 
     # Expected actions for screen types (primary action for each screen)
     SCREEN_EXPECTED_ACTIONS = {
-        'title': {'start'},
-        'dialog': {'a'},
-        'battle': {'a', 'up', 'down', 'left', 'right'},
-        'battle_move_select': {'a', 'up', 'down', 'left', 'right', 'b'},
-        'menu': {'a', 'b', 'up', 'down'},
-        'overworld': {'a', 'up', 'down', 'left', 'right', 'start'},
-        'name_entry': {'a', 'up', 'down', 'left', 'right'},
-        'yes_no': {'a', 'up', 'down'},
-        'loading': {'wait'},
-        'unknown': set(VALID_ACTIONS),
+        'title': frozenset({'start'}),
+        'dialog': frozenset({'a'}),
+        'battle': frozenset({'a', 'up', 'down', 'left', 'right'}),
+        'battle_move_select': frozenset({'a', 'up', 'down', 'left', 'right', 'b'}),
+        'menu': frozenset({'a', 'b', 'up', 'down'}),
+        'overworld': frozenset({'a', 'up', 'down', 'left', 'right', 'start'}),
+        'name_entry': frozenset({'a', 'up', 'down', 'left', 'right'}),
+        'yes_no': frozenset({'a', 'up', 'down'}),
+        'loading': frozenset({'wait'}),
+        'unknown': VALID_ACTIONS,
     }
 
     def __init__(self, state_data: Optional[Dict] = None):
@@ -72,16 +121,16 @@ class GameState:
         if ai_screen_type and self.screen_confidence > 0.7:
             if ai_screen_type != self.screen_type and self.screen_type != 'unknown':
                 # AI thinks it's a different screen than we detected
-                expected = self.SCREEN_EXPECTED_ACTIONS.get(self.screen_type, set())
+                expected = self.SCREEN_EXPECTED_ACTIONS.get(self.screen_type, frozenset())
                 if action not in expected and action != 'wait':
                     return {
                         'valid': False,
                         'reason': f"Screen mismatch: detected '{self.screen_type}' but AI said '{ai_screen_type}'",
-                        'suggested_action': list(expected)[0] if expected else 'a'
+                        'suggested_action': next(iter(expected), 'a')
                     }
 
         # Validate action makes sense for screen type
-        expected_actions = self.SCREEN_EXPECTED_ACTIONS.get(self.screen_type, set())
+        expected_actions = self.SCREEN_EXPECTED_ACTIONS.get(self.screen_type, frozenset())
         if self.screen_confidence > 0.8 and action not in expected_actions and action != 'wait':
             # High confidence screen detection but unexpected action
             # Only warn, don't reject - AI might see something we don't
@@ -109,21 +158,11 @@ class GameState:
         # Pattern 1: Same action 3+ times
         if len(set(last_three)) == 1:
             stuck_action = last_three[0]
-            suggestions = {
-                'a': 'Try moving with arrows or press B',
-                'b': 'Try A to confirm or arrows to navigate',
-                'start': 'This might be a dialog - try A instead',
-                'select': 'Try A or START instead',
-                'up': 'Try A to interact or a different direction',
-                'down': 'Try A to interact or a different direction',
-                'left': 'Try A to interact or a different direction',
-                'right': 'Try A to interact or a different direction',
-            }
             return {
                 'stuck': True,
                 'pattern': 'same_action_repeated',
                 'action': stuck_action,
-                'suggestion': suggestions.get(stuck_action, 'Try a different action')
+                'suggestion': _STUCK_SUGGESTIONS.get(stuck_action, 'Try a different action')
             }
 
         # Pattern 2: Oscillating between two actions
@@ -146,35 +185,15 @@ class GameState:
         if not self.ocr_text:
             return hints
 
-        ocr_upper = self.ocr_text.upper()
-
-        # Detect specific game situations
-        if 'PROF' in ocr_upper or 'OAK' in ocr_upper:
-            hints.append('Prof Oak is speaking - press A to advance dialog')
-
-        if 'YES' in ocr_upper and 'NO' in ocr_upper:
-            hints.append('Yes/No choice detected - use up/down to select, A to confirm')
-
-        if 'FIGHT' in ocr_upper:
-            hints.append('Battle menu visible - FIGHT is usually top-left')
-
-        if any(word in ocr_upper for word in ['PALLET', 'VIRIDIAN', 'PEWTER', 'CERULEAN']):
-            hints.append('Town/city name detected - in overworld or reading sign')
-
-        if 'POISON' in ocr_upper or 'BURN' in ocr_upper or 'SLEEP' in ocr_upper:
-            hints.append('Status condition mentioned - may need to heal')
-
-        if 'LEARNED' in ocr_upper:
-            hints.append('Pokemon learned a move - press A to continue')
-
-        if 'LEVEL' in ocr_upper and 'UP' in ocr_upper:
-            hints.append('Level up - press A to continue')
-
-        if 'NICKNAME' in ocr_upper:
-            hints.append('Nickname prompt - select NO for faster gameplay')
+        # One scan collects every keyword present, then rules are checked
+        # against that set in their canonical order
+        found = {m.lastgroup for m in _HINT_KEYWORD_RE.finditer(self.ocr_text.upper())}
+        if not found:
+            return hints
 
-        if 'ED' in ocr_upper or 'END' in ocr_upper:
-            hints.append('Name entry END button detected - navigate there to confirm')
+        for required, hint in _HINT_RULES:
+            if all(not found.isdisjoint(any_of) for any_of in required):
+                hints.append(hint)
 
         return hints
 
@@ -191,6 +210,45 @@ class GameState:
         }
 
 
+# Map screen types to prompt files
+PROMPT_FILES = {
+    'title': 'title.txt',
+    'dialog': 'dialog.txt',
+    'battle': 'battle.txt',
+    'battle_move_select': 'battle_moves.txt',
+    'menu': 'menu.txt',
+    'overworld': 'overworld.txt',
+    'name_entry': 'name_entry.txt',
+    'yes_no': 'yes_no.txt',
+    'loading': 'loading.txt',
+    'unknown': 'unknown.txt',
+}
+
+PROMPT_DIR = os.path.join(os.path.dirname(__file__), 'prompts')
+
+
+def _fallback_prompt(screen_type: str) -> str:
+    """Minimal prompt used when a prompt file is missing."""
+    return f"""Screen type: {screen_type}. Analyze the screenshot and decide the next action.
+RESPOND WITH JSON: {{"action": "<button>", "commentary": "<what you see>", "confidence": <0.0-1.0>}}"""
+
+
+def _read_prompts() -> Dict[str, str]:
+    """Read every prompt file once, substituting the fallback for missing ones."""
+    prompts = {}
+    for screen_type, filename in PROMPT_FILES.items():
+        try:
+            with open(os.path.join(PROMPT_DIR, filename), 'r') as f:
+                prompts[screen_type] = f.read()
+        except FileNotFoundError:
+            prompts[screen_type] = _fallback_prompt(screen_type)
+    return prompts
+
+
+# Prompts are loaded at import so requests never touch the filesystem
+_PROMPTS = MappingProxyType(_read_prompts())
+
+
 def load_prompt(screen_type: str) -> str:
     """
     Load the appropriate prompt for a screen type.
@@ -201,32 +259,7 @@ def load_prompt(screen_type: str) -> str:
     Returns:
         The prompt text for that screen type
     """
-    import os
-
-    # Map screen types to prompt files
-    prompt_map = {
-        'title': 'title.txt',
-        'dialog': 'dialog.txt',
-        'battle': 'battle.txt',
-        'battle_move_select': 'battle_moves.txt',
-        'menu': 'menu.txt',
-        'overworld': 'overworld.txt',
-        'name_entry': 'name_entry.txt',
-        'yes_no': 'yes_no.txt',
-        'loading': 'loading.txt',
-        'unknown': 'unknown.txt',
-    }
-
-    filename = prompt_map.get(screen_type, 'unknown.txt')
-    prompt_path = os.path.join(os.path.dirname(__file__), 'prompts', filename)
-
-    try:
-        with open(prompt_path, 'r') as f:
-            return f.read()
-    except FileNotFoundError:
-        # Fallback minimal prompt
-        return f"""Screen type: {screen_type}. Analyze the screenshot and decide the next action.
-RESPOND WITH JSON: {{"action": "<button>", "commentary": "<what you see>", "confidence": <0.0-1.0>}}"""
+    return _PROMPTS.get(screen_type, _PROMPTS['unknown'])
 
 
 def build_user_message(game_state: GameState) -> str:
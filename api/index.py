@@ -4,30 +4,83 @@ This handles AI decision-making via the xAI API.
 """
 
 import os
+import gzip
 import json
-import base64
+import hmac
+import hashlib
+import logging
+import threading
+import importlib.util
+import urllib.request
+from io import BytesIO
+from collections import Counter, OrderedDict
 from http.server import BaseHTTPRequestHandler
 from urllib.parse import parse_qs, urlparse
 
-# Try to import openai for xAI API
+logger = logging.getLogger(__name__)
+
+# The openai SDK (and the httpx/pydantic stack behind it) is only imported
+# when a client is first needed, so cold starts that just serve health
+# checks or the HTML page don't pay for it
+OPENAI_AVAILABLE = importlib.util.find_spec('openai') is not None
+
+# orjson is optional - a faster drop-in for the request/response JSON
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj).encode()
+    _loads = json.loads
+
+# pybase64 is optional - a SIMD drop-in for the screenshot decode/encode
+try:
+    import pybase64 as _b64
+except ImportError:
+    import base64 as _b64
+
+# Pillow is optional - it lets near-identical frames share a cache entry
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+
+# Helpers shared with api/action.py
 try:
-    from openai import OpenAI
-    OPENAI_AVAILABLE = True
+    from .shared import InFlightRequests, JsonObjectScanner, dhash_image, extract_json_object
 except ImportError:
-    OPENAI_AVAILABLE = False
+    from shared import InFlightRequests, JsonObjectScanner, dhash_image, extract_json_object
+
+
+# One client per warm process, so calls reuse its keep-alive connections
+_CLIENT = None
+_CLIENT_KEY = None
+_CLIENT_LOCK = threading.Lock()
 
 
 def get_xai_client():
-    """Get xAI client instance."""
+    """Get the shared xAI client instance."""
+    global _CLIENT, _CLIENT_KEY
     api_key = os.getenv('XAI_API_KEY')
     if not api_key or not OPENAI_AVAILABLE:
         return None
-    return OpenAI(api_key=api_key, base_url="https://api.x.ai/v1")
+    if _CLIENT is not None and _CLIENT_KEY == api_key:
+        return _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None or _CLIENT_KEY != api_key:
+            from openai import OpenAI
+            _CLIENT = OpenAI(api_key=api_key, base_url="https://api.x.ai/v1")
+            _CLIENT_KEY = api_key
+        return _CLIENT
 
 
-def get_game_action(client, image_base64, game_state, recent_actions=None, context=None):
-    """Get game action from Grok AI."""
-    system_prompt = """You are Grok, an AI playing Pokemon Red/Blue/Yellow on a Game Boy. Your goal is to complete the game - catch Pokemon, defeat gym leaders, and become the Pokemon Champion.
+# Sent byte-identical as the first message of every action call so the
+# provider can reuse its prompt-prefix cache; per-request text goes in the
+# user message only
+_SYSTEM_PROMPT = """You are Grok, an AI playing Pokemon Red/Blue/Yellow on a Game Boy. Your goal is to complete the game - catch Pokemon, defeat gym leaders, and become the Pokemon Champion.
 
 You can see the game screen and must decide what button to press next. The available buttons are:
 - a: Confirm/Select/Talk/Interact
@@ -50,213 +103,669 @@ RESPONSE FORMAT:
 You must respond with a JSON object containing:
 {
     "action": "button_name",
-    "commentary": "Your reasoning (1-2 sentences max)",
+    "commentary": "Your reasoning (max 10 words)",
     "confidence": 0.0-1.0
 }
 
-Only output the JSON, nothing else."""
+Look at the screenshot and decide the next action. Only output the JSON, nothing else."""
+
+_ANALYZE_SYSTEM_PROMPT = "Analyze this Pokemon game screenshot. Identify: screen type (battle/overworld/menu/dialogue/title), what's happening, and any important details. Respond with JSON: {\"screen_type\": \"type\", \"description\": \"brief desc\", \"details\": \"important info\"}"
+
+_VALID_ACTIONS = frozenset(("a", "b", "up", "down", "left", "right", "start", "select"))
+
+
+class LFUCache:
+    """Bounded cache that evicts the least frequently used entry."""
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._hits = Counter()
+        self._lock = threading.Lock()  # requests are served concurrently
+
+    def get(self, key):
+        """Return the cached value for key, or None."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._hits[key] += 1
+            return value
+
+    def set(self, key, value):
+        """Store a value, evicting the least used entry when full."""
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.max_entries:
+                # Ties go to the oldest entry, since OrderedDict keeps insertion order
+                victim = min(self._entries, key=lambda k: self._hits[k])
+                del self._entries[victim]
+                del self._hits[victim]
+            self._entries[key] = value
+            self._hits[key] += 1
+
+    def clear(self):
+        """Drop every entry."""
+        with self._lock:
+            self._entries.clear()
+            self._hits.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
 
+_ACTION_CACHE = LFUCache(max_entries=512)
+
+# Screen analysis depends on the screenshot alone, keyed by its dHash
+_ANALYZE_CACHE = LFUCache(max_entries=256)
+
+
+class KVCache:
+    """
+    Shared cache tier on Vercel KV, spoken to over its Upstash Redis REST API.
+
+    Survives cold starts and is shared by every instance, so it sits behind
+    the in-process LFU cache. Failures and timeouts are treated as misses -
+    the KV store is never allowed to break or noticeably slow a request.
+    """
+
+    def __init__(self, url, token, ttl_seconds=3600, timeout=0.5, prefix="gpp:action:"):
+        self.url = url.rstrip("/")
+        self.token = token
+        self.ttl_seconds = ttl_seconds
+        self.timeout = timeout
+        self.prefix = prefix
+
+    def _key(self, key):
+        return self.prefix + hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+    def _command(self, *args):
+        request = urllib.request.Request(
+            self.url,
+            data=_dumps(list(args)),
+            headers={"Authorization": f"Bearer {self.token}", "Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return _loads(response.read()).get("result")
+
+    def get(self, key):
+        """Return the cached value for key, or None."""
+        try:
+            raw = self._command("GET", self._key(key))
+            return _loads(raw) if raw else None
+        except (OSError, ValueError) as e:
+            logger.debug("KV get failed: %s", e)
+            return None
+
+    def set(self, key, value):
+        """Store a value with the configured TTL."""
+        self._store(self._key(key), _dumps(value).decode())
+
+    def set_in_background(self, key, value):
+        """
+        Store a value without blocking the caller.
+
+        The value is serialized up front, so the caller may keep using it;
+        only the REST round trip runs on the daemon thread.
+        """
+        args = (self._key(key), _dumps(value).decode())
+        threading.Thread(target=self._store, args=args, daemon=True).start()
+
+    def _store(self, kv_key, payload):
+        try:
+            self._command("SET", kv_key, payload, "EX", self.ttl_seconds)
+        except (OSError, ValueError) as e:
+            logger.debug("KV set failed: %s", e)
+
+
+# Only used when a Vercel KV store is linked to the project
+_KV_CACHE = None
+if os.getenv('KV_REST_API_URL') and os.getenv('KV_REST_API_TOKEN'):
+    _KV_CACHE = KVCache(os.getenv('KV_REST_API_URL'), os.getenv('KV_REST_API_TOKEN'))
+
+# Native Game Boy resolution; anything larger only costs vision tokens
+SCREEN_SIZE = (160, 144)
+
+
+def normalize_screenshot(image_base64):
+    """
+    Downscale an up-scaled screenshot to native Game Boy resolution.
+
+    Returns (image_base64, image) where image is the decoded PIL image, or
+    None if Pillow is unavailable or the data could not be decoded.
+    """
+    if not PIL_AVAILABLE:
+        return image_base64, None
+    try:
+        img = Image.open(BytesIO(_b64.b64decode(image_base64, validate=False)))
+        img.load()
+    except Exception:
+        return image_base64, None
+
+    if img.width > SCREEN_SIZE[0] or img.height > SCREEN_SIZE[1]:
+        img = img.resize(SCREEN_SIZE, Image.NEAREST)
+        buf = BytesIO()
+        img.save(buf, "PNG", optimize=True)
+        image_base64 = _b64.b64encode(buf.getvalue()).decode()
+    return image_base64, img
+
+
+def screenshot_dhash(image_base64, image=None):
+    """
+    dHash of a base64 screenshot, or None if unavailable.
+
+    An already decoded image can be passed to skip decoding the base64 again.
+    """
+    if not PIL_AVAILABLE:
+        return None
+    try:
+        return dhash_image(image or Image.open(BytesIO(_b64.b64decode(image_base64, validate=False))))
+    except Exception:
+        return None
+
+
+class ScreenTemplates:
+    """
+    Known screens answered locally with a fixed action, matched by dHash.
+
+    Comparing 64-bit hashes costs microseconds, against a second or more for
+    a vision call. Templates load from TEMPLATE_DIR at import time, named
+    <action>-<name>.png; they are read-only once loaded, since a template
+    overrides the AI for every client whose frame matches it.
+    """
+
+    def __init__(self, max_distance=2):
+        self.max_distance = max_distance
+        self._templates = {}
+
+    def add(self, name, action, dhash):
+        """Register (or replace) a template."""
+        self._templates[name] = (action, dhash)
+
+    def match(self, dhash):
+        """Return (name, action) of the closest template within range, or None."""
+        best = None
+        best_distance = self.max_distance + 1
+        for name, (action, template_hash) in self._templates.items():
+            distance = (dhash ^ template_hash).bit_count()
+            if distance < best_distance:
+                best, best_distance = (name, action), distance
+        return best
+
+    def describe(self):
+        """List the registered templates."""
+        return [{"name": name, "action": action} for name, (action, _) in self._templates.items()]
+
+    def load_dir(self, path):
+        """Load every <action>-<name>.png template in path."""
+        if not PIL_AVAILABLE or not os.path.isdir(path):
+            return
+        for filename in sorted(os.listdir(path)):
+            stem, ext = os.path.splitext(filename)
+            action, _, name = stem.partition('-')
+            if ext.lower() != '.png' or action not in _VALID_ACTIONS or not name:
+                continue
+            try:
+                with Image.open(os.path.join(path, filename)) as img:
+                    dhash = dhash_image(img.convert("L").resize(SCREEN_SIZE, Image.NEAREST))
+            except OSError:
+                continue
+            self.add(name, action, dhash)
+
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'screen_templates')
+_SCREEN_TEMPLATES = ScreenTemplates()
+_SCREEN_TEMPLATES.load_dir(TEMPLATE_DIR)
+
+
+def make_action_cache_key(image_base64, game_state, recent_actions=None, context=None, image=None):
+    """Key an action request by screenshot, game state, recent actions and context."""
+    dhash = screenshot_dhash(image_base64, image)
+    if dhash is not None:
+        image_hash = f"d{dhash:016x}"
+    else:
+        image_hash = hashlib.blake2b(image_base64.encode(), digest_size=16).hexdigest()
+    state_str = json.dumps(game_state or {}, sort_keys=True)
+    actions_str = ",".join(map(str, (recent_actions or [])[-5:]))
+    return f"{image_hash}|{state_str}|{actions_str}|{context or ''}"
+
+
+def log_prompt_cache_usage(response):
+    """
+    Log how many prompt tokens the provider served from its prefix cache.
+
+    Accepts a completion or a stream chunk; only the final chunk of a
+    stream carries usage.
+    """
+    details = getattr(getattr(response, "usage", None), "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None)
+    if cached_tokens is not None:
+        logger.info("Prompt cache_hit=%s cached_tokens=%d", cached_tokens > 0, cached_tokens)
+
+
+# Requests currently waiting on xAI, keyed by action cache key
+_INFLIGHT = InFlightRequests()
+INFLIGHT_WAIT_SECONDS = 30
+
+
+def get_game_action(client, image_base64, game_state, recent_actions=None, context=None, image=None,
+                    image_url=None):
+    """
+    Get game action from Grok AI.
+
+    image_url, when given, is sent to xAI in place of an inline data URL;
+    image_base64 is then only used to build the cache key.
+    """
+    cache_key = make_action_cache_key(image_base64, game_state, recent_actions, context, image)
+    cached = _ACTION_CACHE.get(cache_key)
+    if cached is not None:
+        return dict(cached)
+
+    if _KV_CACHE is not None:
+        cached = _KV_CACHE.get(cache_key)
+        if cached is not None:
+            _ACTION_CACHE.set(cache_key, cached)
+            return dict(cached)
+
+    image_url = image_url or f"data:image/png;base64,{image_base64}"
+
+    def fetch():
+        request = request_game_action_batched if BATCH_ENABLED else _request_game_action
+        result, parsed = request(client, image_url, game_state, recent_actions, context)
+        if parsed:
+            _ACTION_CACHE.set(cache_key, result)
+            if _KV_CACHE is not None:
+                # Off the request path; waiters only need the in-process result
+                _KV_CACHE.set_in_background(cache_key, result)
+        return result
+
+    # Coalesce concurrent identical requests into a single xAI call
+    result = _INFLIGHT.run(cache_key, fetch, INFLIGHT_WAIT_SECONDS)
+    if result is None:
+        return {"action": "a", "commentary": "Timed out waiting on duplicate request", "confidence": 0.0}
+    return result
+
+
+def build_state_prompt(game_state, recent_actions=None, context=None):
+    """Describe the game state, recent actions and context for the user message."""
     user_prompt_parts = ["Current game state:"]
+    append = user_prompt_parts.append
     if game_state:
-        if game_state.get("location"):
-            user_prompt_parts.append(f"- Location: {game_state['location']}")
-        if game_state.get("pokemon_team"):
-            team_str = ", ".join([f"{p['name']} Lv{p['level']}" for p in game_state['pokemon_team']])
-            user_prompt_parts.append(f"- Team: {team_str}")
-        if game_state.get("badges") is not None:
-            user_prompt_parts.append(f"- Badges: {game_state['badges']}/8")
+        location = game_state.get("location")
+        if location:
+            append(f"- Location: {location}")
+        team = game_state.get("pokemon_team")
+        if team:
+            append("- Team: " + ", ".join(f"{p['name']} Lv{p['level']}" for p in team))
+        badges = game_state.get("badges")
+        if badges is not None:
+            append(f"- Badges: {badges}/8")
 
     if recent_actions:
-        user_prompt_parts.append(f"\nRecent actions: {' -> '.join(recent_actions[-10:])}")
+        append("\nRecent actions: " + " -> ".join(map(str, recent_actions[-10:])))
 
     if context:
-        user_prompt_parts.append(f"\nContext: {context}")
+        append(f"\nContext: {context}")
+
+    return "\n".join(user_prompt_parts)
+
+
+def _clip01(x):
+    """Clamp a confidence value to [0, 1]; NaN becomes 0."""
+    if isinstance(x, bool) or not isinstance(x, (int, float)):
+        x = float(x)
+    if 0.0 <= x <= 1.0:
+        return float(x)
+    return 1.0 if x > 1.0 else 0.0
+
+
+def parse_action(data):
+    """Validate a decoded model answer into an action result."""
+    action = str(data.get("action", "a")).lower()
+    if action not in _VALID_ACTIONS:
+        action = "a"
 
-    user_prompt_parts.append("\nLook at the screenshot and decide the next action. Respond with JSON only.")
+    return {
+        "action": action,
+        "commentary": data.get("commentary", "Making a move..."),
+        "confidence": _clip01(data.get("confidence", 0.5))
+    }
 
+
+def _request_game_action(client, image_url, game_state, recent_actions, context):
+    """Ask Grok for an action; returns (result, parsed)."""
     try:
-        response = client.chat.completions.create(
+        stream = client.chat.completions.create(
             model="grok-2-vision-1212",
             messages=[
-                {"role": "system", "content": system_prompt},
+                {"role": "system", "content": _SYSTEM_PROMPT},
                 {
                     "role": "user",
                     "content": [
-                        {"type": "text", "text": "\n".join(user_prompt_parts)},
+                        {"type": "text", "text": build_state_prompt(game_state, recent_actions, context)},
                         {
                             "type": "image_url",
-                            "image_url": {"url": f"data:image/png;base64,{image_base64}"}
+                            "image_url": {"url": image_url}
                         }
                     ]
                 }
             ],
-            max_tokens=500,
-            temperature=0.7
+            max_tokens=80,
+            temperature=0.7,
+            response_format={"type": "json_object"},
+            stream=True,
+            stream_options={"include_usage": True}
         )
 
-        response_text = response.choices[0].message.content.strip()
-
-        # Parse JSON from response
-        import re
-        if response_text.startswith('{'):
-            data = json.loads(response_text)
-        else:
-            json_match = re.search(r'\{[^{}]*\}', response_text)
-            if json_match:
-                data = json.loads(json_match.group())
-            else:
-                data = {"action": "a", "commentary": "Parsing error", "confidence": 0.1}
+        # Stop collecting text once the JSON object closes. The stream is
+        # still drained: in JSON mode only the finish chunk and the usage
+        # chunk follow the closing brace, and the usage one feeds the
+        # prompt cache log
+        pieces = []
+        scanner = JsonObjectScanner()
+        closed = False
+        try:
+            for chunk in stream:
+                log_prompt_cache_usage(chunk)
+                if closed or not chunk.choices:
+                    continue
+                piece = chunk.choices[0].delta.content
+                if piece:
+                    pieces.append(piece)
+                    closed = scanner.feed(piece)
+        finally:
+            stream.close()
+        response_text = "".join(pieces).strip()
+
+        # JSON mode makes the reply a bare object
+        try:
+            data = _loads(response_text)
+        except ValueError:
+            return {"action": "a", "commentary": "Parsing error", "confidence": 0.1}, False
+        if not isinstance(data, dict):
+            return {"action": "a", "commentary": "Parsing error", "confidence": 0.1}, False
 
-        action = data.get("action", "a").lower()
-        valid_actions = ["a", "b", "up", "down", "left", "right", "start", "select"]
-        if action not in valid_actions:
-            action = "a"
+        return parse_action(data), True
 
+    except Exception as e:
         return {
-            "action": action,
-            "commentary": data.get("commentary", "Making a move..."),
-            "confidence": min(1.0, max(0.0, float(data.get("confidence", 0.5))))
-        }
+            "action": "a",
+            "commentary": f"API error: {str(e)[:50]}",
+            "confidence": 0.0
+        }, False
+
+
+# Dynamic batching: requests that share a location and team and arrive
+# within BATCH_WINDOW_SECONDS of each other go to xAI as one multi-image
+# call. Off unless XAI_DYNAMIC_BATCH=1, since it only pays off when one
+# warm process serves several agents at once.
+BATCH_ENABLED = os.getenv('XAI_DYNAMIC_BATCH') == '1'
+BATCH_WINDOW_SECONDS = 0.05
+BATCH_MAX_SIZE = 4
+
+
+class _BatchItem:
+    """One action request waiting for its slot in a batch to be answered."""
+
+    def __init__(self, image_url, game_state, recent_actions, context):
+        self.image_url = image_url
+        self.game_state = game_state
+        self.recent_actions = recent_actions
+        self.context = context
+        self.done = threading.Event()
+        self.result = None
+        self.parsed = False
+
+
+class _Batch:
+    """Requests collected during one batch window."""
+
+    def __init__(self):
+        self.items = []
+        self.full = threading.Event()
+
+
+# Batches still accepting requests, keyed by batch_key
+_OPEN_BATCHES = {}
+_BATCH_LOCK = threading.Lock()
+
+
+def batch_key(game_state):
+    """Requests can share a batch only if location and team match."""
+    game_state = game_state or {}
+    team = tuple(
+        (str(p.get('name')), p.get('level')) for p in game_state.get('pokemon_team') or ()
+        if isinstance(p, dict)
+    )
+    return (str(game_state.get('location', '')), team)
+
+
+def request_game_action_batched(client, image_url, game_state, recent_actions, context):
+    """
+    Like _request_game_action, but may share one xAI call with other
+    compatible requests arriving within the batch window.
+    """
+    item = _BatchItem(image_url, game_state, recent_actions, context)
+    key = batch_key(game_state)
+
+    with _BATCH_LOCK:
+        batch = _OPEN_BATCHES.get(key)
+        is_leader = batch is None
+        if is_leader:
+            batch = _OPEN_BATCHES[key] = _Batch()
+        batch.items.append(item)
+        if len(batch.items) >= BATCH_MAX_SIZE:
+            _OPEN_BATCHES.pop(key, None)
+            batch.full.set()
+
+    if not is_leader:
+        if item.done.wait(INFLIGHT_WAIT_SECONDS) and item.result is not None:
+            return item.result, item.parsed
+        return {"action": "a", "commentary": "Timed out waiting on batched request", "confidence": 0.0}, False
+
+    batch.full.wait(BATCH_WINDOW_SECONDS)
+    with _BATCH_LOCK:
+        if _OPEN_BATCHES.get(key) is batch:
+            del _OPEN_BATCHES[key]
 
+    try:
+        if len(batch.items) == 1:
+            item.result, item.parsed = _request_game_action(
+                client, image_url, game_state, recent_actions, context)
+        else:
+            _request_batch(client, batch.items)
+    finally:
+        for other in batch.items:
+            other.done.set()
+
+    return item.result, item.parsed
+
+
+def _request_batch(client, items):
+    """Answer several screenshots with one call, falling back to one call each."""
+    content = [{"type": "text", "text": build_state_prompt(items[0].game_state)}]
+    for index, item in enumerate(items, 1):
+        text = f"Screenshot {index}:"
+        if item.recent_actions:
+            text += "\nRecent actions: " + " -> ".join(map(str, item.recent_actions[-10:]))
+        if item.context:
+            text += f"\nContext: {item.context}"
+        content.append({"type": "text", "text": text})
+        content.append({
+            "type": "image_url",
+            "image_url": {"url": item.image_url}
+        })
+    content.append({
+        "type": "text",
+        "text": f"Decide the next action for each of the {len(items)} screenshots independently. "
+                f"Respond with a JSON array of {len(items)} objects in the format above, in screenshot order."
+    })
+
+    answers = None
+    try:
+        response = client.chat.completions.create(
+            model="grok-2-vision-1212",
+            messages=[
+                {"role": "system", "content": _SYSTEM_PROMPT},
+                {"role": "user", "content": content}
+            ],
+            max_tokens=80 * len(items),
+            temperature=0.7
+        )
+        log_prompt_cache_usage(response)
+        response_text = response.choices[0].message.content
+        start, end = response_text.find('['), response_text.rfind(']')
+        if start != -1 and end > start:
+            answers = _loads(response_text[start:end + 1])
     except Exception as e:
+        logger.warning("Batched action request failed: %s", e)
+
+    if (isinstance(answers, list) and len(answers) == len(items)
+            and all(isinstance(a, dict) for a in answers)):
+        for item, answer in zip(items, answers):
+            try:
+                item.result, item.parsed = parse_action(answer), True
+            except (TypeError, ValueError):
+                item.result, item.parsed = parse_action({}), False
+        return
+
+    for item in items:
+        item.result, item.parsed = _request_game_action(
+            client, item.image_url, item.game_state, item.recent_actions, item.context)
+
+
+def handle_action(data):
+    """
+    Turn a decoded /api/action request body into a response dict.
+
+    Independent of the HTTP transport - the handler below only parses and
+    writes bytes around this.
+    """
+    client = get_xai_client()
+
+    if not client:
         return {
+            "error": "xAI API not configured",
             "action": "a",
-            "commentary": f"API error: {str(e)[:50]}",
+            "commentary": "API key not set - using default",
             "confidence": 0.0
         }
 
+    image_base64 = data.get('screenshot', '')
+    screenshot_url = data.get('screenshot_url')
+    game_state = data.get('game_state', {})
+    recent_actions = data.get('recent_actions', [])
+    context = data.get('context', None)
 
-class handler(BaseHTTPRequestHandler):
-    """Vercel serverless function handler."""
+    if not isinstance(screenshot_url, str) or not screenshot_url.startswith(('https://', 'http://')):
+        screenshot_url = None
 
-    def do_GET(self):
-        """Handle GET requests."""
-        parsed = urlparse(self.path)
-        path = parsed.path
+    if screenshot_url:
+        # Pre-uploaded screenshot: xAI fetches it, so there is nothing to
+        # re-encode here. Any inline copy still keys the cache.
+        return get_game_action(client, image_base64 or screenshot_url, game_state, recent_actions, context,
+                               image_url=screenshot_url)
 
-        if path == '/api/health':
-            self._send_json({"status": "ok", "api_available": OPENAI_AVAILABLE and bool(os.getenv('XAI_API_KEY'))})
-        elif path == '/api/status':
-            self._send_json({
-                "status": "ready",
-                "api_configured": bool(os.getenv('XAI_API_KEY')),
-                "message": "Grok Plays Pokemon API is ready"
-            })
-        else:
-            self._send_html()
+    if not image_base64:
+        return {
+            "error": "No screenshot provided",
+            "action": "a",
+            "commentary": "No image to analyze",
+            "confidence": 0.0
+        }
 
-    def do_POST(self):
-        """Handle POST requests."""
-        parsed = urlparse(self.path)
-        path = parsed.path
+    image_base64, image = normalize_screenshot(image_base64)
 
-        # Read request body
-        content_length = int(self.headers.get('Content-Length', 0))
-        body = self.rfile.read(content_length).decode('utf-8') if content_length > 0 else '{}'
+    # Known screens skip the vision call entirely
+    if image is not None:
+        dhash = screenshot_dhash(image_base64, image)
+        match = _SCREEN_TEMPLATES.match(dhash) if dhash is not None else None
+        if match:
+            name, action = match
+            return {
+                "action": action,
+                "commentary": f"Recognized {name} screen (local template)",
+                "confidence": 0.95,
+                "local_template": name
+            }
 
-        try:
-            data = json.loads(body)
-        except:
-            data = {}
+    return get_game_action(client, image_base64, game_state, recent_actions, context, image)
 
-        if path == '/api/action':
-            self._handle_action_request(data)
-        elif path == '/api/analyze':
-            self._handle_analyze_request(data)
-        else:
-            self._send_json({"error": "Not found"}, 404)
 
-    def _handle_action_request(self, data):
-        """Handle AI action request."""
-        client = get_xai_client()
+def handle_analyze(data):
+    """Turn a decoded /api/analyze request body into a response dict."""
+    client = get_xai_client()
 
-        if not client:
-            self._send_json({
-                "error": "xAI API not configured",
-                "action": "a",
-                "commentary": "API key not set - using default",
-                "confidence": 0.0
-            })
-            return
+    if not client:
+        return {"error": "xAI API not configured"}
 
-        image_base64 = data.get('screenshot', '')
-        game_state = data.get('game_state', {})
-        recent_actions = data.get('recent_actions', [])
-        context = data.get('context', None)
-
-        if not image_base64:
-            self._send_json({
-                "error": "No screenshot provided",
-                "action": "a",
-                "commentary": "No image to analyze",
-                "confidence": 0.0
-            })
-            return
+    image_base64 = data.get('screenshot', '')
 
-        result = get_game_action(client, image_base64, game_state, recent_actions, context)
-        self._send_json(result)
+    if not image_base64:
+        return {"error": "No screenshot provided"}
 
-    def _handle_analyze_request(self, data):
-        """Handle screen analysis request."""
-        client = get_xai_client()
+    image_base64, image = normalize_screenshot(image_base64)
+    dhash = screenshot_dhash(image_base64, image)
+    if dhash is not None:
+        cache_key = f"d{dhash:016x}"
+    else:
+        cache_key = hashlib.blake2b(image_base64.encode(), digest_size=16).hexdigest()
+    cached = _ANALYZE_CACHE.get(cache_key)
+    if cached is not None:
+        return dict(cached)
 
-        if not client:
-            self._send_json({"error": "xAI API not configured"})
-            return
+    try:
+        response = client.chat.completions.create(
+            model="grok-2-vision-1212",
+            messages=[
+                {
+                    "role": "system",
+                    "content": _ANALYZE_SYSTEM_PROMPT
+                },
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": "What's on this screen?"},
+                        {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_base64}"}}
+                    ]
+                }
+            ],
+            max_tokens=120,
+            temperature=0.0,
+            seed=0,
+            response_format={"type": "json_object"}
+        )
 
-        image_base64 = data.get('screenshot', '')
+        response_text = response.choices[0].message.content.strip()
+        try:
+            if response_text.startswith('{'):
+                result = _loads(response_text)
+            else:
+                json_text = extract_json_object(response_text)
+                result = _loads(json_text) if json_text else {"description": response_text}
+        except:
+            return {"description": response_text[:200]}
 
-        if not image_base64:
-            self._send_json({"error": "No screenshot provided"})
-            return
+        if isinstance(result, dict):
+            _ANALYZE_CACHE.set(cache_key, result)
+        return result
 
-        try:
-            response = client.chat.completions.create(
-                model="grok-2-vision-1212",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "Analyze this Pokemon game screenshot. Identify: screen type (battle/overworld/menu/dialogue/title), what's happening, and any important details. Respond with JSON: {\"screen_type\": \"type\", \"description\": \"brief desc\", \"details\": \"important info\"}"
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": "What's on this screen?"},
-                            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_base64}"}}
-                        ]
-                    }
-                ],
-                max_tokens=300,
-                temperature=0.3
-            )
-
-            response_text = response.choices[0].message.content.strip()
-            try:
-                if response_text.startswith('{'):
-                    result = json.loads(response_text)
-                else:
-                    import re
-                    match = re.search(r'\{[^{}]*\}', response_text)
-                    result = json.loads(match.group()) if match else {"description": response_text}
-            except:
-                result = {"description": response_text[:200]}
+    except Exception as e:
+        return {"error": str(e)}
 
-            self._send_json(result)
 
-        except Exception as e:
-            self._send_json({"error": str(e)})
+def is_admin_request(authorization):
+    """
+    Check an Authorization header against the API_ADMIN_TOKEN secret.
 
-    def _send_json(self, data, status=200):
-        """Send JSON response."""
-        self.send_response(status)
-        self.send_header('Content-Type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+    Admin endpoints are disabled entirely while the variable is unset.
+    """
+    token = os.getenv('API_ADMIN_TOKEN')
+    if not token:
+        return False
+    return hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode())
 
-    def _send_html(self):
-        """Send the main HTML page."""
-        html = """<!DOCTYPE html>
+
+# The landing page is static, so it is encoded and compressed once at import
+_HTML_PAGE = """<!DOCTYPE html>
 <html>
 <head>
     <title>Grok Plays Pokemon</title>
@@ -285,19 +794,115 @@ class handler(BaseHTTPRequestHandler):
             <li><code>GET /api/status</code> - API status</li>
             <li><code>POST /api/action</code> - Get AI action for game state</li>
             <li><code>POST /api/analyze</code> - Analyze game screenshot</li>
+            <li><code>POST /api/cache/clear</code> - Clear the cached AI responses (needs <code>Authorization: Bearer $API_ADMIN_TOKEN</code>)</li>
+            <li><code>GET /api/templates</code> - List screens answered without the AI</li>
         </ul>
     </div>
 </body>
 </html>"""
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html')
-        self.end_headers()
-        self.wfile.write(html.encode())
+_HTML_BYTES = _HTML_PAGE.encode()
+_HTML_GZ = gzip.compress(_HTML_BYTES, 6)
+
+_JSON_HEADERS = (('Content-Type', 'application/json'), ('Access-Control-Allow-Origin', '*'))
+
+
+class handler(BaseHTTPRequestHandler):
+    """Vercel serverless function handler."""
+
+    # Every response carries Content-Length, so the connection can stay open
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """Handle GET requests."""
+        parsed = urlparse(self.path)
+        path = parsed.path
+
+        if path == '/api/health':
+            self._send_cacheable_json({"status": "ok", "api_available": OPENAI_AVAILABLE and bool(os.getenv('XAI_API_KEY'))})
+        elif path == '/api/status':
+            self._send_cacheable_json({
+                "status": "ready",
+                "api_configured": bool(os.getenv('XAI_API_KEY')),
+                "message": "Grok Plays Pokemon API is ready"
+            })
+        elif path == '/api/templates':
+            self._send_json({"templates": _SCREEN_TEMPLATES.describe()})
+        else:
+            self._send_html()
+
+    def do_POST(self):
+        """Handle POST requests."""
+        parsed = urlparse(self.path)
+        path = parsed.path
+
+        # Read request body
+        content_length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(content_length) if content_length > 0 else b'{}'
+
+        try:
+            data = _loads(body)
+        except:
+            data = {}
+
+        if path == '/api/action':
+            self._send_json(handle_action(data))
+        elif path == '/api/analyze':
+            self._send_json(handle_analyze(data))
+        elif path == '/api/cache/clear':
+            if not is_admin_request(self.headers.get('Authorization', '')):
+                self._send_json({"error": "Forbidden"}, 403)
+                return
+            cleared = len(_ACTION_CACHE) + len(_ANALYZE_CACHE)
+            _ACTION_CACHE.clear()
+            _ANALYZE_CACHE.clear()
+            self._send_json({"status": "ok", "cleared": cleared})
+        else:
+            self._send_json({"error": "Not found"}, 404)
+
+    def _respond(self, status, headers, body=b''):
+        """Write the status line, headers and body with a single write."""
+        self.log_request(status)
+        lines = [f"{self.protocol_version} {status} {self.responses.get(status, ('',))[0]}"]
+        lines.extend(f"{name}: {value}" for name, value in headers)
+        if status != 304:
+            lines.append(f"Content-Length: {len(body)}")
+        lines.append("Connection: keep-alive")
+        self.wfile.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + body)
+
+    def _send_json(self, data, status=200):
+        """Send JSON response."""
+        self._respond(status, _JSON_HEADERS, _dumps(data))
+
+    def _send_cacheable_json(self, data, max_age=5):
+        """
+        Send a JSON response the CDN may cache briefly, answering a matching
+        If-None-Match with 304.
+        """
+        payload = _dumps(data)
+        etag = '"' + hashlib.blake2b(payload, digest_size=8).hexdigest() + '"'
+        cache_headers = (('ETag', etag), ('Cache-Control', f'public, max-age={max_age}'))
+        if self.headers.get('If-None-Match') == etag:
+            self._respond(304, cache_headers)
+            return
+
+        self._respond(200, _JSON_HEADERS + cache_headers, payload)
+
+    def _send_html(self):
+        """Send the main HTML page, gzipped when the client accepts it."""
+        headers = (
+            ('Content-Type', 'text/html; charset=utf-8'),
+            ('Cache-Control', 'public, max-age=3600'),
+            ('Vary', 'Accept-Encoding'),
+        )
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            self._respond(200, headers + (('Content-Encoding', 'gzip'),), _HTML_GZ)
+        else:
+            self._respond(200, headers, _HTML_BYTES)
 
     def do_OPTIONS(self):
         """Handle CORS preflight."""
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.end_headers()
+        self._respond(200, (
+            ('Access-Control-Allow-Origin', '*'),
+            ('Access-Control-Allow-Methods', 'GET, POST, OPTIONS'),
+            ('Access-Control-Allow-Headers', 'Content-Type, Authorization'),
+        ))
@@ -0,0 +1,128 @@
+"""
+Shared helpers for the Grok Plays Pokemon serverless functions.
+
+Used by both api/action.py and api/index.py.
+"""
+
+import threading
+
+# Pillow is optional for the handlers; dhash_image is only called with
+# images they decoded, so it is present whenever that happens
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+class JsonObjectScanner:
+    """Tracks brace depth over streamed text to spot a complete JSON object."""
+
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+        self.consumed = 0  # Characters read, up to and including the closing brace
+
+    def feed(self, text: str) -> bool:
+        """Consume more text; return True once the first object has closed."""
+        for i, ch in enumerate(text):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == '\\':
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = self.started
+            elif ch == '{':
+                self.depth += 1
+                self.started = True
+            elif ch == '}' and self.started:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.consumed += i + 1
+                    return True
+        self.consumed += len(text)
+        return False
+
+
+def extract_json_object(text: str) -> str | None:
+    """
+    Return the first complete, possibly nested, JSON object in text, or None.
+
+    A single linear pass tracking brace depth, skipping braces inside strings.
+    """
+    start = text.find('{')
+    if start < 0:
+        return None
+    scanner = JsonObjectScanner()
+    if scanner.feed(text[start:]):
+        return text[start:start + scanner.consumed]
+    return None
+
+
+class _InFlight:
+    """An xAI request that other callers with the same key can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class InFlightRequests:
+    """
+    Coalesces concurrent identical requests into a single xAI call.
+
+    The first caller for a key runs the request; callers arriving while it
+    is in flight wait for its result instead of sending their own.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, fetch, timeout: float) -> dict | None:
+        """
+        Return fetch() for key, shared with concurrent callers of the same key.
+
+        Waiting callers get a copy of the leader's result dict, or None if
+        the leader failed or did not finish within timeout seconds.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._flights[key] = _InFlight()
+
+        if not is_leader:
+            if flight.done.wait(timeout) and flight.result is not None:
+                return dict(flight.result)
+            return None
+
+        result = None
+        try:
+            result = fetch()
+            return result
+        finally:
+            flight.result = result
+            flight.done.set()
+            with self._lock:
+                self._flights.pop(key, None)
+
+
+def dhash_image(image) -> int:
+    """
+    64-bit difference hash of a PIL image.
+
+    Consecutive Game Boy frames in menus and dialogs usually differ by a
+    pixel or two at most, which leaves the dHash unchanged, so frames whose
+    hashes are a few bits apart can be treated as the same screen.
+    """
+    pixels = list(image.convert("L").resize((9, 8), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(0, 72, 9):
+        for col in range(8):
+            value = (value << 1) | (pixels[row + col + 1] > pixels[row + col])
+    return value
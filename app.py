@@ -1,19 +1,34 @@
+import eventlet
+# Patch before anything else imports socket/threading/time, so Flask, the
+# xAI client and the autonomous controller's threads all yield to the hub
+eventlet.monkey_patch()
+
 import os
 import time
+import threading
 import json
 import logging
-import threading
-import base64
-from datetime import datetime
+from collections import deque
+from itertools import islice
 from io import BytesIO
 from werkzeug.utils import secure_filename
 from flask import Flask, render_template, jsonify, request, Response
+from flask.json.provider import DefaultJSONProvider, _default as _flask_json_default
 from flask_socketio import SocketIO, emit
-import eventlet
+from eventlet import tpool
+from eventlet.event import Event
+from eventlet.queue import LightQueue, Empty
 from dotenv import load_dotenv
-from emulator import PokemonEmulator
+from emulator import PokemonEmulator, ACTION_IDS
 from autonomous_controller import AutonomousController, get_controller, reset_controller
 
+# orjson is optional - a much faster encoder for the state and log payloads
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
 # Load environment variables
 load_dotenv()
 
@@ -26,7 +41,14 @@ ROM_DIRECTORY = 'roms'
 UPLOAD_FOLDER = 'roms'
 ALLOWED_EXTENSIONS = {'gb', 'gbc'}
 MAX_ROM_SIZE = 5 * 1024 * 1024  # 5MB max file size
-SCREENSHOT_INTERVAL = 1.0  # seconds between screenshots
+STATE_UPDATE_FRAMES = 30  # push game state every 30 frames (~0.5 s)
+SCREENSHOT_FRAMES = 60  # broadcast a screenshot every 60 frames (~1 s)
+MAX_ACTION_LOG = 1000  # oldest entries fall off the deques below
+MAX_COMMENTARY_HISTORY = 2000
+SCREENSHOT_FORCE_INTERVAL = 5.0  # resend an unchanged frame this often so new clients get one
+IDLE_POLL_SECONDS = 0.1  # how often a game loop with a stopped emulator re-checks it
+SEQUENCE_DELAY_FRAMES = 10  # gap between queued sequence actions, as in emulator.execute_sequence
+STREAM_JPEG_QUALITY = 75  # live feed only; /api/screenshot stays lossless by default
 
 # Pokemon ROM checksums for validation (first few bytes of each ROM)
 POKEMON_ROM_SIGNATURES = {
@@ -35,19 +57,70 @@ POKEMON_ROM_SIGNATURES = {
     'pokemon_yellow': b'\x8B\x76\x89\xC0'  # Pokemon Yellow
 }
 
+# All signatures are 4 bytes, so a header matches with one dict lookup
+ROM_SIGNATURE_NAMES = {
+    signature: rom_name.replace('_', ' ').title()
+    for rom_name, signature in POKEMON_ROM_SIGNATURES.items()
+}
+SIGNATURE_LENGTH = 4
+
+# Start of the Nintendo logo, which every GB/GBC cartridge header carries at 0x104
+NINTENDO_LOGO = b'\xCE\xED\x66\x66\xCC\x0D\x00\x13\xE8\x23\x3E\x23\xC9\x3E\x23\xC9'
+NINTENDO_LOGO_OFFSET = 0x104
+
 # Initialize Flask and SocketIO
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'grok-plays-pokemon-secret!'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_ROM_SIZE
-socketio = SocketIO(app, async_mode='eventlet')
+
+def dumps_compact(obj):
+    """Serialize obj to compact JSON text, with orjson when it is installed."""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj, separators=(',', ':'))
+
+if ORJSON_AVAILABLE:
+    class OrjsonProvider(DefaultJSONProvider):
+        """Flask JSON provider backed by orjson, used by jsonify()."""
+
+        sort_keys = False
+
+        def dumps(self, obj, **kwargs):
+            option = orjson.OPT_NON_STR_KEYS
+            if kwargs.get("indent"):
+                option |= orjson.OPT_INDENT_2
+            return orjson.dumps(obj, default=_flask_json_default, option=option).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+    class OrjsonCodec:
+        """json-module stand-in for Socket.IO packet encoding."""
+
+        @staticmethod
+        def dumps(obj, **kwargs):
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+        @staticmethod
+        def loads(s, **kwargs):
+            return orjson.loads(s)
+
+    app.json = OrjsonProvider(app)
+    # Emits from the game loop run outside any app context, where
+    # flask.json would fall back to the stdlib encoder
+    socketio = SocketIO(app, async_mode='eventlet', json=OrjsonCodec)
+else:
+    socketio = SocketIO(app, async_mode='eventlet')
 
 # AI settings
 AI_SETTINGS = {
     "playerAI": "grok",
     "pokemonAI": "claude",
     "mode": "dual",
-    "currentAI": "Grok"  # Currently active AI (changes in dual mode)
+    "currentAI": "Grok",  # Currently active AI (changes in dual mode)
+    "_overworld_ai": "Grok",  # Resolved by update_ai_settings
+    "_battle_ai": "Claude"
 }
 
 # Create directories if they don't exist
@@ -56,65 +129,90 @@ os.makedirs('static/screenshots', exist_ok=True)
 
 # Global variables
 emulator = None
-emulator_lock = threading.Lock()
+# While the game loop runs it is the emulator's only owner: other code posts
+# work to its mailbox (see call_emulator) and reads the state and frame
+# snapshots it publishes, so nothing needs to lock
+emulator_mailbox = LightQueue()
+pending_actions = LightQueue()  # queued /api/execute_sequence buttons, one per slot
+next_action_frame = 0
+latest_state = None  # last pushed state, already serialized to JSON text
+connected_clients = 0  # Socket.IO clients; state pushes and screenshots stop at zero
+last_frame_hash = None
+last_frame_sent = 0.0
 game_thread = None
-screenshot_thread = None
 autonomous_controller = None
-commentary_history = []
-action_log = []
+commentary_history = deque(maxlen=MAX_COMMENTARY_HISTORY)
+action_log = deque(maxlen=MAX_ACTION_LOG)
 game_running = False
-game_start_time = None
+game_start_time = None  # time.monotonic() when the game threads started
 current_rom_path = None
 current_rom_name = None
+rom_stat_cache = None  # {"path", "exists", "size"} for current_rom_path
+
+def rom_stat(refresh=False):
+    """Whether the current ROM exists and its size, cached until the ROM changes."""
+    global rom_stat_cache
+
+    if refresh or rom_stat_cache is None or rom_stat_cache["path"] != current_rom_path:
+        exists = current_rom_path is not None and os.path.exists(current_rom_path)
+        rom_stat_cache = {
+            "path": current_rom_path,
+            "exists": exists,
+            "size": os.path.getsize(current_rom_path) if exists else 0
+        }
+    return rom_stat_cache
 
 def allowed_file(filename):
     """Check if the file has an allowed extension."""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+ROM_HEADER_SIZE = 400  # enough for the signature, logo and title checks
+
+def _validate_header_bytes(header, file_size):
+    """Identify a Pokemon Red, Blue, or Yellow ROM from its first bytes and size."""
+    logger.info(f"ROM header bytes: {header[:16].hex()}")
+
+    # Check for known signatures
+    rom_name = ROM_SIGNATURE_NAMES.get(header[:SIGNATURE_LENGTH])
+    if rom_name:
+        logger.info(f"Matched signature for: {rom_name}")
+        return rom_name
+
+    # Additional checks for Pokemon ROMs
+    # Check for Nintendo logo (common in GB/GBC ROMs)
+    if header.startswith(NINTENDO_LOGO, NINTENDO_LOGO_OFFSET):
+        logger.info("Found Nintendo logo, assuming valid Pokemon ROM")
+        return "Pokemon Red"  # Default to Red if we find Nintendo logo
+
+    # Check for common Pokemon title strings in the title area (around 0x134-0x143)
+    if len(header) > 0x150:
+        title_area = header[0x134:0x144].upper()
+        logger.info("Title area: %r", title_area)
+
+        if b'POKEMON' in title_area:
+            if b'BLUE' in title_area:
+                return "Pokemon Blue"
+            elif b'YELLOW' in title_area:
+                return "Pokemon Yellow"
+            else:
+                return "Pokemon Red"
+
+    # For now, if it's a .gb or .gbc file of reasonable size, accept it
+    # This is a more permissive approach
+    if 500000 < file_size < 2000000:  # Between 500KB and 2MB
+        logger.info(f"Accepting ROM based on file size: {file_size} bytes")
+        return "Pokemon Red"  # Default assumption
+
+    logger.error(f"No valid signature found. Header: {header[:16].hex()}, Size: {file_size}")
+    return None
+
 def validate_pokemon_rom(file_path):
     """Validate if the ROM is a Pokemon Red, Blue, or Yellow game."""
     try:
         with open(file_path, 'rb') as f:
-            # Read first 400 bytes to check for various signatures and titles
-            header = f.read(400)
-            logger.info(f"ROM header bytes: {header[:16].hex()}")
-
-            # Check for known signatures
-            for rom_name, signature in POKEMON_ROM_SIGNATURES.items():
-                if header.startswith(signature):
-                    logger.info(f"Matched signature for: {rom_name}")
-                    return rom_name.replace('_', ' ').title()
-
-            # Additional checks for Pokemon ROMs
-            # Check for Nintendo logo (common in GB/GBC ROMs)
-            nintendo_logo = b'\xCE\xED\x66\x66\xCC\x0D\x00\x13\xE8\x23\x3E\x23\xC9\x3E\x23\xC9'
-            if nintendo_logo in header:
-                logger.info("Found Nintendo logo, assuming valid Pokemon ROM")
-                return "Pokemon Red"  # Default to Red if we find Nintendo logo
-
-            # Check for common Pokemon title strings in the title area (around 0x134-0x143)
-            if len(header) > 0x150:
-                title_area = header[0x134:0x144]
-                title_str = title_area.decode('ascii', errors='ignore').upper()
-                logger.info(f"Title area: {title_str}")
-
-                if 'POKEMON' in title_str:
-                    if 'BLUE' in title_str:
-                        return "Pokemon Blue"
-                    elif 'YELLOW' in title_str:
-                        return "Pokemon Yellow"
-                    else:
-                        return "Pokemon Red"
-
-            # For now, if it's a .gb or .gbc file of reasonable size, accept it
-            # This is a more permissive approach
-            file_size = os.path.getsize(file_path)
-            if 500000 < file_size < 2000000:  # Between 500KB and 2MB
-                logger.info(f"Accepting ROM based on file size: {file_size} bytes")
-                return "Pokemon Red"  # Default assumption
-
-            logger.error(f"No valid signature found. Header: {header[:16].hex()}, Size: {file_size}")
-            return None
+            header = f.read(ROM_HEADER_SIZE)
+            file_size = os.fstat(f.fileno()).st_size
+        return _validate_header_bytes(header, file_size)
     except Exception as e:
         logger.error(f"Error validating ROM: {e}")
         return None
@@ -149,24 +247,31 @@ def initialize_emulator(rom_path=None):
         logger.error(f"Invalid or unsupported ROM: {rom_path}")
         return False
 
-    try:
-        with emulator_lock:
-            # Stop existing emulator if running
-            if emulator is not None:
-                logger.info("Stopping existing emulator")
-                try:
-                    emulator.stop()
-                except Exception as e:
-                    logger.warning(f"Error stopping existing emulator: {e}")
+    def replace_emulator():
+        global emulator, latest_state, current_rom_path, current_rom_name
 
-            logger.info(f"Creating PokemonEmulator with ROM: {rom_path}")
-            emulator = PokemonEmulator(rom_path, rom_name)
+        # Stop existing emulator if running
+        if emulator is not None:
+            logger.info("Stopping existing emulator")
+            try:
+                emulator.stop()
+            except Exception as e:
+                logger.warning(f"Error stopping existing emulator: {e}")
 
-            logger.info("Starting emulator")
-            emulator.start()
+        logger.info(f"Creating PokemonEmulator with ROM: {rom_path}")
+        emulator = PokemonEmulator(rom_path, rom_name)
+        emulator.on_tick(publish_state, every=STATE_UPDATE_FRAMES)
+        emulator.on_tick(publish_screenshot, every=SCREENSHOT_FRAMES)
+        latest_state = None
 
-            current_rom_path = rom_path
-            current_rom_name = rom_name
+        logger.info("Starting emulator")
+        emulator.start()
+
+        current_rom_path = rom_path
+        current_rom_name = rom_name
+
+    try:
+        call_emulator(replace_emulator)
 
         logger.info(f"Emulator initialized successfully with {rom_name}")
         return True
@@ -179,41 +284,69 @@ def initialize_emulator(rom_path=None):
         logger.error(f"Full traceback: {traceback.format_exc()}")
         return False
 
+def call_emulator(fn, *args):
+    """
+    Run fn(*args) on the emulator's owner and return the result.
+
+    While the game loop runs the call is queued on its mailbox and executed
+    between ticks; otherwise nothing else is driving the emulator and fn is
+    called directly. Exceptions raised by fn propagate to the caller.
+    """
+    if not game_running:
+        return fn(*args)
+    done = Event()
+    emulator_mailbox.put((fn, args, done))
+    return done.wait()
+
+def run_mailbox_item(item):
+    """Run one queued emulator call and hand the result back to its caller."""
+    fn, args, done = item
+    try:
+        done.send(fn(*args))
+    except Exception as e:
+        done.send_exception(e)
+
+def drain_mailbox():
+    """Run every queued emulator call."""
+    while not emulator_mailbox.empty():
+        run_mailbox_item(emulator_mailbox.get_nowait())
+
+def run_pending_action():
+    """Press the next queued sequence button once its delay has elapsed."""
+    global next_action_frame
+
+    if pending_actions.empty() or emulator.frame_count < next_action_frame:
+        return
+    # Same timing as emulator.execute_sequence (5 frames held, 5 after the
+    # release, then the delay), but spread over the loop's regular ticks
+    emulator.press_action(pending_actions.get_nowait())
+    next_action_frame = emulator.frame_count + 10 + SEQUENCE_DELAY_FRAMES
+
 def game_loop():
-    """Main game loop that runs in a separate thread."""
-    global game_running
+    """Main game loop; the single owner of the emulator while it runs."""
+    global game_running, next_action_frame
     
     logger.info("Starting game loop")
     game_running = True
     
     try:
         while game_running:
-            with emulator_lock:
-                if emulator and emulator.is_running:
-                    # Advance the game by a few frames
-                    emulator.tick(2)
-                    
-                    # Check if we need to update game state
-                    if emulator.frame_count % 30 == 0:  # Every 30 frames (roughly 0.5 seconds)
-                        emulator.update_game_state()
-                        
-                        # Update current AI based on mode and game state
-                        if AI_SETTINGS["mode"] == "dual":
-                            # This is a simplified check - in a real implementation,
-                            # you would check the game state to determine if in battle
-                            in_battle = emulator.detect_game_screen() == "battle"
-                            if in_battle:
-                                AI_SETTINGS["currentAI"] = "Claude" if AI_SETTINGS["pokemonAI"] == "claude" else "Grok"
-                            else:
-                                AI_SETTINGS["currentAI"] = "Grok" if AI_SETTINGS["playerAI"] == "grok" else "Claude"
-                        else:  # single mode
-                            # Use only the player AI for everything
-                            AI_SETTINGS["currentAI"] = "Grok" if AI_SETTINGS["playerAI"] == "grok" else "Claude"
-                        
-                        # Push updated state to clients
-                        state = emulator.get_state()
-                        state["currentAI"] = AI_SETTINGS["currentAI"]  # Add current AI to state
-                        socketio.emit('state_update', state)
+            if not (emulator and emulator.is_running):
+                # Idle: block on the mailbox so posted calls still run at
+                # once, and otherwise only wake up to re-check the flags
+                try:
+                    run_mailbox_item(emulator_mailbox.get(timeout=IDLE_POLL_SECONDS))
+                except Empty:
+                    pass
+                continue
+
+            drain_mailbox()
+
+            if emulator and emulator.is_running:
+                # Advance the game by a few frames; state pushes and
+                # screenshots run from the emulator's tick callbacks
+                emulator.tick(2)
+                run_pending_action()
             
             # Sleep to control game loop frequency
             eventlet.sleep(1/30)  # 30 FPS target
@@ -222,42 +355,113 @@ def game_loop():
     finally:
         logger.info("Game loop stopped")
         game_running = False
+        # Anything posted before the loop ended still gets an answer
+        drain_mailbox()
+        # Queued sequence buttons are dropped rather than replayed on restart
+        while not pending_actions.empty():
+            pending_actions.get_nowait()
+        next_action_frame = 0
+
+def publish_state(emu):
+    """Tick callback: refresh the game state, pick the active AI and push it."""
+    global latest_state
+
+    if not connected_clients:
+        # Nobody is watching: skip the state read and the push,
+        # and let /api/state read fresh state on demand instead
+        latest_state = None
+        return
+
+    # get_state() refreshes the state and hands back our own copy
+    state = emu.get_state()
+
+    # Roles are resolved in update_ai_settings; the snapshot already
+    # says whether we are in a battle
+    if state.get("in_battle"):
+        AI_SETTINGS["currentAI"] = AI_SETTINGS["_battle_ai"]
+    else:
+        AI_SETTINGS["currentAI"] = AI_SETTINGS["_overworld_ai"]
+
+    state["currentAI"] = AI_SETTINGS["currentAI"]  # Add current AI to state
+
+    # Serialize once: the same text goes to every client and to /api/state
+    latest_state = dumps_compact(state)
+    socketio.emit('state_update', latest_state)
+
+def publish_screenshot(emu):
+    """Tick callback: broadcast the current frame unless it is unchanged."""
+    global last_frame_hash, last_frame_sent
+
+    if not connected_clients:
+        # Make sure the next viewer to connect gets a frame straight away
+        last_frame_hash = None
+        return
 
-def screenshot_loop():
-    """Loop that captures and broadcasts screenshots."""
-    logger.info("Starting screenshot loop")
-    
     try:
-        while game_running:
-            with emulator_lock:
-                if emulator and emulator.is_running:
-                    # Capture screenshot
-                    screenshot = emulator.get_screenshot()
-                    
-                    # Convert to base64 for web display
-                    buffered = BytesIO()
-                    screenshot.save(buffered, format="PNG")
-                    img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-                    
-                    # Emit to clients
-                    socketio.emit('screenshot_update', {'image': img_str})
-            
-            # Sleep to control screenshot frequency
-            eventlet.sleep(SCREENSHOT_INTERVAL)
+        # Skip building, encoding and sending frames identical to the last one
+        frame_hash = emu.frame_hash()
+        now = time.monotonic()
+        if frame_hash != last_frame_hash or now - last_frame_sent >= SCREENSHOT_FORCE_INTERVAL:
+            if broadcast_screenshot(emu.get_screenshot()):
+                last_frame_hash = frame_hash
+                last_frame_sent = now
     except Exception as e:
-        logger.error(f"Error in screenshot loop: {e}")
+        logger.error(f"Error broadcasting screenshot: {e}")
+
+# Encodes run on eventlet's OS thread pool, so each pool thread reuses its
+# own buffer (monkey-patched locals are per greenlet, i.e. per OS thread here)
+_encode_local = threading.local()
+screenshot_encoding = False  # a broadcast encode is in flight on the pool
+
+def encode_frame(image, fmt, **params):
+    """Encode an image to bytes in the calling thread's buffer."""
+    buffer = getattr(_encode_local, "buffer", None)
+    if buffer is None:
+        buffer = _encode_local.buffer = BytesIO()
+    buffer.seek(0)
+    buffer.truncate()
+    image.save(buffer, format=fmt, **params)
+    return buffer.getvalue()
+
+def broadcast_screenshot(screenshot):
+    """
+    Start encoding a captured frame for every client, off the hub.
+
+    Returns False without doing anything while the previous frame is still
+    being encoded, so a slow encoder drops frames instead of queueing them.
+    """
+    global screenshot_encoding
+
+    if screenshot_encoding:
+        return False
+    screenshot_encoding = True
+    # convert() copies the frame here, so the emulator can keep drawing
+    eventlet.spawn_n(send_screenshot, screenshot.convert("RGB"))
+    return True
+
+def send_screenshot(frame):
+    """Encode a frame on the thread pool and emit it to every client."""
+    global screenshot_encoding
+
+    try:
+        # JPEG is far cheaper to encode and send than PNG for a live preview
+        payload = tpool.execute(encode_frame, frame, "JPEG", quality=STREAM_JPEG_QUALITY)
+
+        # Raw bytes go out as a Socket.IO binary attachment - no base64
+        socketio.emit('screenshot_update', {'image': payload, 'format': 'jpeg'})
+    except Exception as e:
+        logger.error(f"Error broadcasting screenshot: {e}")
     finally:
-        logger.info("Screenshot loop stopped")
+        screenshot_encoding = False
 
 def start_game_threads():
-    """Start the game and screenshot threads."""
-    global game_thread, screenshot_thread, game_running, game_start_time, autonomous_controller
+    """Start the game loop and autonomous controller."""
+    global game_thread, game_running, game_start_time, autonomous_controller
 
     if not game_running:
         game_running = True
-        game_start_time = datetime.now()
+        game_start_time = time.monotonic()
         game_thread = eventlet.spawn(game_loop)
-        screenshot_thread = eventlet.spawn(screenshot_loop)
 
         # Initialize and start autonomous controller
         if emulator:
@@ -271,7 +475,7 @@ def start_game_threads():
         logger.info("Game threads started")
 
 def stop_game_threads():
-    """Stop the game and screenshot threads."""
+    """Stop the game loop and autonomous controller."""
     global game_running, autonomous_controller
 
     game_running = False
@@ -296,9 +500,17 @@ def update_ai_settings(settings):
     if "mode" in settings:
         AI_SETTINGS["mode"] = settings["mode"]
     
+    # Resolve which AI plays the overworld and which plays battles once,
+    # so the state tick only has to pick between them
+    AI_SETTINGS["_overworld_ai"] = "Grok" if AI_SETTINGS["playerAI"] == "grok" else "Claude"
+    if AI_SETTINGS["mode"] == "dual":
+        AI_SETTINGS["_battle_ai"] = "Claude" if AI_SETTINGS["pokemonAI"] == "claude" else "Grok"
+    else:  # single mode: the player AI handles everything
+        AI_SETTINGS["_battle_ai"] = AI_SETTINGS["_overworld_ai"]
+    
     # Set the initial current AI based on the player AI
     if AI_SETTINGS["mode"] == "single":
-        AI_SETTINGS["currentAI"] = "Grok" if AI_SETTINGS["playerAI"] == "grok" else "Claude"
+        AI_SETTINGS["currentAI"] = AI_SETTINGS["_overworld_ai"]
     
     # Broadcast the updated settings to all clients
     socketio.emit('ai_settings_update', {
@@ -325,7 +537,7 @@ def status():
     rom_info = {
         "rom_name": current_rom_name,
         "rom_path": current_rom_path,
-        "rom_exists": current_rom_path is not None and os.path.exists(current_rom_path)
+        "rom_exists": rom_stat()["exists"]
     }
 
     if emulator is None:
@@ -334,12 +546,11 @@ def status():
             "rom_info": rom_info
         })
 
-    with emulator_lock:
-        return jsonify({
-            "status": "running" if emulator.is_running else "stopped",
-            "frame_count": emulator.frame_count,
-            "rom_info": rom_info
-        })
+    return jsonify({
+        "status": "running" if emulator.is_running else "stopped",
+        "frame_count": emulator.frame_count,
+        "rom_info": rom_info
+    })
 
 @app.route('/api/state')
 def get_state():
@@ -349,28 +560,41 @@ def get_state():
     if emulator is None:
         return jsonify({"error": "Emulator not initialized"})
     
-    with emulator_lock:
-        state = emulator.get_state()
-        state["currentAI"] = AI_SETTINGS["currentAI"]  # Add current AI to state
-        return jsonify(state)
+    if latest_state is not None:
+        return Response(latest_state, mimetype='application/json')
+
+    state = call_emulator(emulator.get_state)
+    state["currentAI"] = AI_SETTINGS["currentAI"]  # Add current AI to state
+    return jsonify(state)
 
 @app.route('/api/screenshot')
 def get_screenshot():
-    """API endpoint to get the current screenshot."""
+    """API endpoint to get the current screenshot (PNG, or JPEG with ?fmt=jpeg)."""
     global emulator
     
     if emulator is None:
         return jsonify({"error": "Emulator not initialized"})
     
-    with emulator_lock:
-        screenshot = emulator.get_screenshot()
-        
-        # Convert to bytes for HTTP response
-        img_io = BytesIO()
-        screenshot.save(img_io, 'PNG')
-        img_io.seek(0)
-        
-        return Response(img_io.getvalue(), mimetype='image/png')
+    # Snapshot the frame on demand, between ticks, so the game loop does no
+    # screen work for it when nobody asks
+    screenshot, frame_hash = call_emulator(
+        lambda: (emulator.get_screenshot().copy(), emulator.frame_hash()))
+
+    # The frame checksum identifies the image, so pollers that already
+    # have this frame get a 304 without anything being encoded
+    fmt = 'jpeg' if request.args.get('fmt') == 'jpeg' else 'png'
+    etag = f"{frame_hash:08x}-{fmt}"
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+    if etag in request.if_none_match:
+        return Response(status=304, headers=headers)
+
+    # Convert to bytes for HTTP response, on the thread pool so the game
+    # loop and other requests keep running meanwhile
+    if fmt == 'jpeg':
+        payload = tpool.execute(encode_frame, screenshot.convert("RGB"), "JPEG", quality=STREAM_JPEG_QUALITY)
+        return Response(payload, mimetype='image/jpeg', headers=headers)
+
+    return Response(tpool.execute(encode_frame, screenshot, "PNG"), mimetype='image/png', headers=headers)
 
 @app.route('/api/ai_settings', methods=['GET', 'POST'])
 def ai_settings():
@@ -432,20 +656,15 @@ def execute_action():
         "frame_count": emulator.frame_count if emulator else 0
     })
 
-    # Keep only the last 1000 actions to prevent memory issues
-    if len(action_log) > 1000:
-        action_log.pop(0)
-
     # Execute the action in the emulator
-    with emulator_lock:
-        success = emulator.execute_action(action)
+    success = call_emulator(emulator.execute_action, action)
 
-        if success:
-            logger.info(f"Action executed: {action}")
-            return jsonify({"success": True, "action": action})
-        else:
-            logger.warning(f"Failed to execute action: {action}")
-            return jsonify({"success": False, "error": f"Invalid action: {action}"})
+    if success:
+        logger.info(f"Action executed: {action}")
+        return jsonify({"success": True, "action": action})
+    else:
+        logger.warning(f"Failed to execute action: {action}")
+        return jsonify({"success": False, "error": f"Invalid action: {action}"})
 
 @app.route('/api/execute_sequence', methods=['POST'])
 def execute_sequence():
@@ -462,6 +681,19 @@ def execute_sequence():
     actions = data['actions']
     commentary = data.get('commentary', '')
 
+    # Reject the whole sequence up front: queued buttons can't report a
+    # failure later, and a partial run would leave the game in a guessed state
+    if not isinstance(actions, list):
+        return jsonify({"success": False, "error": "'actions' must be a list"})
+    invalid = [action for action in actions if not isinstance(action, str) or action not in ACTION_IDS]
+    if invalid:
+        return jsonify({
+            "success": False,
+            "error": "Unknown actions in sequence",
+            "invalid": invalid,
+            "actions": actions
+        })
+
     # Add commentary to history
     if commentary:
         commentary_history.append({
@@ -479,33 +711,42 @@ def execute_sequence():
             "frame_count": emulator.frame_count if emulator else 0
         })
 
-        # Keep only the last 1000 actions to prevent memory issues
-        if len(action_log) > 1000:
-            action_log.pop(0)
-
-    # Execute the action sequence in the emulator
-    with emulator_lock:
-        results = emulator.execute_sequence(actions)
-
+    if game_running:
+        # Let the game loop press the buttons between its own ticks instead
+        # of holding it for the whole sequence
+        for action in actions:
+            pending_actions.put(action)
         return jsonify({
-            "success": all(results),
-            "results": results,
+            "success": True,
+            "queued": len(actions),
             "actions": actions
         })
 
+    # Nothing is ticking the emulator, so run the sequence right away
+    results = call_emulator(emulator.execute_sequence, actions)
+
+    return jsonify({
+        "success": all(results),
+        "results": results,
+        "actions": actions
+    })
+
 @app.route('/api/commentary')
 def get_commentary():
     """API endpoint to get the commentary history."""
     global commentary_history
 
-    return jsonify(commentary_history)
+    return jsonify(list(commentary_history))
 
 @app.route('/api/action_log')
 def get_action_log():
-    """API endpoint to get the action log."""
+    """API endpoint to get the action log (only the newest ?limit=N entries if given)."""
     global action_log
 
-    return jsonify(action_log)
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit >= 0:
+        return jsonify(list(islice(action_log, max(0, len(action_log) - limit), None)))
+    return jsonify(list(action_log))
 
 @app.route('/api/gameplay_stats')
 def get_gameplay_stats():
@@ -515,9 +756,8 @@ def get_gameplay_stats():
     # Calculate playtime
     playtime_seconds = 0
     playtime_formatted = "00:00:00"
-    if game_start_time and game_running:
-        playtime = datetime.now() - game_start_time
-        playtime_seconds = int(playtime.total_seconds())
+    if game_start_time is not None and game_running:
+        playtime_seconds = int(time.monotonic() - game_start_time)
         hours = playtime_seconds // 3600
         minutes = (playtime_seconds % 3600) // 60
         seconds = playtime_seconds % 60
@@ -600,14 +840,15 @@ def resume_autonomous():
 
 @app.route('/api/rom_info')
 def get_rom_info():
-    """API endpoint to get current ROM information."""
+    """API endpoint to get current ROM information (?refresh=1 re-checks the file)."""
     global current_rom_name, current_rom_path
 
-    if current_rom_path and os.path.exists(current_rom_path):
+    stat = rom_stat(refresh=request.args.get('refresh') == '1')
+    if current_rom_path and stat["exists"]:
         return jsonify({
             "name": current_rom_name,
             "path": current_rom_path,
-            "size": os.path.getsize(current_rom_path),
+            "size": stat["size"],
             "exists": True
         })
     else:
@@ -621,7 +862,7 @@ def get_rom_info():
 @app.route('/api/upload_rom', methods=['POST', 'DELETE'])
 def upload_rom():
     """API endpoint to upload or clear a ROM file."""
-    global current_rom_path, current_rom_name
+    global current_rom_path, current_rom_name, rom_stat_cache
 
     if request.method == 'DELETE':
         # Clear ROM functionality
@@ -631,12 +872,12 @@ def upload_rom():
                 logger.info(f"ROM cleared: {current_rom_name}")
             current_rom_path = None
             current_rom_name = None
+            rom_stat_cache = None
 
             # Stop the emulator if running
             global emulator, game_running
             if emulator is not None:
-                with emulator_lock:
-                    emulator.stop()
+                call_emulator(emulator.stop)
                 emulator = None
                 game_running = False
 
@@ -671,22 +912,26 @@ def upload_rom():
         logger.info(f"Processing file: {filename}, size: {getattr(file, 'content_length', 'unknown')}")
 
         try:
-            # Save the file
-            file.save(file_path)
-            file_size = os.path.getsize(file_path)
-            logger.info(f"File saved successfully. Size: {file_size} bytes")
+            # Validate the ROM from the upload stream so invalid files never touch disk
+            stream = file.stream
+            header = stream.read(ROM_HEADER_SIZE)
+            file_size = stream.seek(0, os.SEEK_END)
+            stream.seek(0)
 
-            # Validate the ROM
-            rom_name = validate_pokemon_rom(file_path)
+            rom_name = _validate_header_bytes(header, file_size)
             if rom_name is None:
-                # Remove invalid file
-                os.remove(file_path)
                 logger.error("Invalid ROM signature")
                 return jsonify({"success": False, "error": "Invalid ROM file. Only Pokemon Red, Blue, and Yellow are supported."})
 
+            # Save the file on a real OS thread; disk writes never yield to the
+            # hub, so saving inline would stall the game loop until done
+            tpool.execute(file.save, file_path)
+            logger.info(f"File saved successfully. Size: {file_size} bytes")
+
             # Set as current ROM
             current_rom_path = file_path
             current_rom_name = rom_name
+            rom_stat_cache = {"path": file_path, "exists": True, "size": file_size}
 
             logger.info(f"ROM uploaded successfully: {rom_name}")
             return jsonify({
@@ -717,8 +962,7 @@ def start_game():
         if not initialize_emulator():
             return jsonify({"error": "Failed to initialize emulator"})
 
-    with emulator_lock:
-        emulator.start()
+    call_emulator(emulator.start)
 
     start_game_threads()
     return jsonify({"success": True, "status": "started"})
@@ -731,14 +975,15 @@ def stop_game():
     stop_game_threads()
     
     if emulator is not None:
-        with emulator_lock:
-            emulator.stop()
+        call_emulator(emulator.stop)
     
     return jsonify({"success": True, "status": "stopped"})
 
 @socketio.on('connect')
 def handle_connect():
     """Handle client connect event."""
+    global connected_clients
+    connected_clients += 1
     logger.info("Client connected")
     emit('commentary_update', {"text": "Connected to Grok Plays Pokémon!"})
     
@@ -754,6 +999,8 @@ def handle_connect():
 @socketio.on('disconnect')
 def handle_disconnect():
     """Handle client disconnect event."""
+    global connected_clients
+    connected_clients = max(0, connected_clients - 1)
     logger.info("Client disconnected")
 
 if __name__ == '__main__':
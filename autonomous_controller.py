@@ -7,22 +7,18 @@ This module manages the autonomous gameplay loop using xAI/Grok for decisions.
 import time
 import logging
 import threading
-from datetime import datetime, timedelta
-from collections import deque
-
-try:
-    import eventlet
-    eventlet.monkey_patch()
-    USE_EVENTLET = True
-except ImportError:
-    USE_EVENTLET = False
+from collections import Counter, deque
+from itertools import islice
 
+from api.shared import dhash_image
 from xai_client import get_xai_client
 
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Set up logging (handlers are configured by the app entry point)
 logger = logging.getLogger(__name__)
 
+# Screens whose dHashes differ in at most this many bits count as the same
+ANALYSIS_HASH_DISTANCE = 2
+
 
 class AutonomousController:
     """
@@ -48,15 +44,20 @@ class AutonomousController:
         self.game_thread = None
 
         # Statistics
-        self.start_time = None
+        self.start_time = None  # time.monotonic() when play started
         self.total_actions = 0
         self.actions_per_minute = 0
         self.recent_actions = deque(maxlen=50)
+        # Opt-in: (timestamp, action, commentary, confidence, location, badges)
+        self.record_history = False
         self.action_history = deque(maxlen=1000)
 
-        # Loop detection
-        self.position_history = deque(maxlen=20)
+        # Loop detection, kept up to date incrementally on every action
         self.loop_detection_threshold = 10
+        self.stuck_window = deque(maxlen=self.loop_detection_threshold)
+        self.stuck_window_counts = Counter()  # Action counts within stuck_window
+        self.last_location = None
+        self.location_streak = 0  # Consecutive checks at last_location
         self.stuck_counter = 0
 
         # Timing
@@ -66,6 +67,8 @@ class AutonomousController:
         # Screen analysis cache
         self.last_screen_analysis = None
         self.screen_analysis_interval = 5  # Analyze screen every N actions
+        self._analysis_hash = None  # dHash of the screen behind last_screen_analysis
+        self.analyses_reused = 0
 
         logger.info("AutonomousController initialized")
 
@@ -82,14 +85,13 @@ class AutonomousController:
 
         self.is_running = True
         self.is_paused = False
-        self.start_time = datetime.now()
+        self.start_time = time.monotonic()
         self.total_actions = 0
 
-        if USE_EVENTLET:
-            self.game_thread = eventlet.spawn(self._game_loop)
-        else:
-            self.game_thread = threading.Thread(target=self._game_loop, daemon=True)
-            self.game_thread.start()
+        # Plain threads and time.sleep throughout: under a monkey-patched server
+        # (eventlet in app.py, or gevent) they are green, otherwise OS threads
+        self.game_thread = threading.Thread(target=self._game_loop, daemon=True)
+        self.game_thread.start()
 
         logger.info("Autonomous controller started")
         self._broadcast_commentary("Grok is now playing Pokemon autonomously!")
@@ -122,38 +124,42 @@ class AutonomousController:
 
         while self.is_running:
             try:
-                sleep_fn = eventlet.sleep if USE_EVENTLET else time.sleep
-
                 if self.is_paused:
-                    sleep_fn(0.5)
+                    time.sleep(0.5)
                     continue
 
                 # Check if emulator is running
                 if not self.emulator or not self.emulator.is_running:
-                    sleep_fn(1)
+                    time.sleep(1)
                     continue
 
                 # Rate limiting
                 if self.last_action_time:
                     elapsed = time.time() - self.last_action_time
                     if elapsed < self.action_delay:
-                        sleep_fn(self.action_delay - elapsed)
+                        time.sleep(self.action_delay - elapsed)
 
                 # Get current game state
                 screenshot = self.emulator.get_screenshot()
                 game_state = self.emulator.get_state()
 
-                # Analyze screen periodically
+                # Analyze the screen periodically as part of the action request,
+                # unless it still looks like the screen we analyzed last time
                 context = None
+                screen_hash = None
                 if action_count % self.screen_analysis_interval == 0:
-                    self.last_screen_analysis = self.xai_client.analyze_screen(screenshot)
-                    context = self.last_screen_analysis.get("suggested_context")
+                    screen_hash = dhash_image(screenshot)
+                    if (self.last_screen_analysis is not None and self._analysis_hash is not None
+                            and (screen_hash ^ self._analysis_hash).bit_count() <= ANALYSIS_HASH_DISTANCE):
+                        self.analyses_reused += 1
+                        context = self.last_screen_analysis.get("suggested_context")
+                        screen_hash = None
 
-                # Get recent actions for context
-                recent = list(self.recent_actions)
+                # Get recent actions for context (the prompt uses the last 10)
+                recent = self._recent_tail(10)
 
                 # Check for stuck/loop detection
-                if self._detect_stuck(game_state, recent):
+                if self._detect_stuck(game_state):
                     context = "STUCK DETECTED: Try a different approach. Maybe go in a new direction or press B to cancel."
                     self.stuck_counter += 1
                     if self.stuck_counter > 5:
@@ -162,80 +168,102 @@ class AutonomousController:
                 else:
                     self.stuck_counter = 0
 
-                # Get action from Grok
-                result = self.xai_client.get_game_action(
-                    screenshot,
-                    game_state,
-                    recent,
-                    context
-                )
+                # Get action from Grok, with a screen analysis in the same call
+                # when one is due
+                if screen_hash is not None:
+                    result, self.last_screen_analysis = self.xai_client.get_action_and_analysis(
+                        screenshot,
+                        game_state,
+                        recent,
+                        context
+                    )
+                    self._analysis_hash = screen_hash
+                else:
+                    result = self.xai_client.get_game_action(
+                        screenshot,
+                        game_state,
+                        recent,
+                        context
+                    )
 
                 action = result["action"]
                 commentary = result["commentary"]
                 confidence = result["confidence"]
 
-                # Execute the action
-                success = self.emulator.execute_action(action)
+                # Press the button; the game loop ticks the emulator and
+                # releases it, so this loop never steps frames itself
+                success = self.emulator.press_action(action)
 
                 if success:
                     self.total_actions += 1
                     action_count += 1
-                    self.recent_actions.append(action)
+                    self._record_action(action)
                     self.last_action_time = time.time()
 
                     # Record in history
-                    self.action_history.append({
-                        "action": action,
-                        "commentary": commentary,
-                        "confidence": confidence,
-                        "timestamp": time.time(),
-                        "game_state": {
-                            "location": game_state.get("location"),
-                            "badges": game_state.get("badges")
-                        }
-                    })
+                    if self.record_history:
+                        self.action_history.append((
+                            self.last_action_time, action, commentary, confidence,
+                            game_state.get("location"), game_state.get("badges")
+                        ))
 
                     # Broadcast update
                     self._broadcast_action(action, commentary, confidence)
 
                     # Log periodically
                     if action_count % 10 == 0:
-                        logger.info(f"Action {action_count}: {action} - {commentary[:50]}...")
+                        logger.info("Action %d: %s - %.50s...", action_count, action, commentary)
 
             except Exception as e:
-                logger.error(f"Error in game loop: {e}")
-                import traceback
-                logger.error(traceback.format_exc())
-                sleep_fn = eventlet.sleep if USE_EVENTLET else time.sleep
-                sleep_fn(2)  # Wait before retrying
+                # Logs the traceback too, formatted only if the record is emitted
+                logger.exception("Error in game loop: %s", e)
+                time.sleep(2)  # Wait before retrying
 
         logger.info("Game loop ended")
 
-    def _detect_stuck(self, game_state, recent_actions):
+    def _record_action(self, action):
+        """Remember an executed action, updating the stuck-detection window."""
+        self.recent_actions.append(action)
+
+        window = self.stuck_window
+        if len(window) == window.maxlen:
+            oldest = window[0]
+            self.stuck_window_counts[oldest] -= 1
+            if not self.stuck_window_counts[oldest]:
+                del self.stuck_window_counts[oldest]
+        window.append(action)
+        self.stuck_window_counts[action] += 1
+
+    def _recent_tail(self, n):
+        """The last n recent actions as a list, without copying the whole deque."""
+        return list(islice(self.recent_actions, max(0, len(self.recent_actions) - n), None))
+
+    def _detect_stuck(self, game_state):
         """Detect if the AI is stuck in a loop."""
-        if len(recent_actions) < self.loop_detection_threshold:
+        window = self.stuck_window
+        if len(window) < self.loop_detection_threshold:
             return False
 
-        # Check for repeated action patterns
-        last_n = recent_actions[-self.loop_detection_threshold:]
-
         # Check for alternating pattern (e.g., left, right, left, right)
-        if len(set(last_n)) <= 2:
+        if len(self.stuck_window_counts) <= 2:
             return True
 
         # Check for exact repetition
-        half = len(last_n) // 2
-        if last_n[:half] == last_n[half:2*half]:
+        half = len(window) // 2
+        if all(window[i] == window[i + half] for i in range(half)):
             return True
 
         # Track position if available
         location = game_state.get("location", "")
-        self.position_history.append(location)
+        if location == self.last_location:
+            self.location_streak += 1
+        else:
+            self.last_location = location
+            self.location_streak = 1
 
         # Check if stuck in same location
-        if len(self.position_history) >= 15:
-            if len(set(list(self.position_history)[-15:])) == 1:
-                return True
+        if self.location_streak >= 15:
+            return True
 
         return False
 
@@ -260,24 +288,25 @@ class AutonomousController:
 
     def get_stats(self):
         """Get current gameplay statistics."""
-        playtime = timedelta(seconds=0)
-        if self.start_time:
-            playtime = datetime.now() - self.start_time
+        playtime = 0
+        if self.start_time is not None:
+            playtime = int(time.monotonic() - self.start_time)
 
         # Calculate actions per minute
-        if self.start_time and self.total_actions > 0:
-            minutes = playtime.total_seconds() / 60
+        if self.start_time is not None and self.total_actions > 0:
+            minutes = playtime / 60
             self.actions_per_minute = self.total_actions / max(minutes, 1)
 
         return {
             "is_running": self.is_running,
             "is_paused": self.is_paused,
-            "playtime": str(playtime).split('.')[0],  # Remove microseconds
-            "playtime_seconds": int(playtime.total_seconds()),
+            "playtime": f"{playtime // 3600}:{playtime // 60 % 60:02d}:{playtime % 60:02d}",
+            "playtime_seconds": playtime,
             "total_actions": self.total_actions,
             "actions_per_minute": round(self.actions_per_minute, 1),
-            "recent_actions": list(self.recent_actions)[-10:],
+            "recent_actions": self._recent_tail(10),
             "last_screen_analysis": self.last_screen_analysis,
+            "analyses_reused": self.analyses_reused,
             "api_available": self.xai_client.is_available()
         }
 
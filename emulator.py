@@ -1,14 +1,16 @@
 import os
 import time
 import logging
+import struct
+import zlib
+from collections import deque
 from pyboy import PyBoy
 from pyboy.utils import WindowEvent
 import numpy as np
 from PIL import Image
 import json
 
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Set up logging (handlers are configured by the app entry point)
 logger = logging.getLogger(__name__)
 
 # Pokemon Red/Blue/Yellow Memory Addresses (RAM)
@@ -46,6 +48,40 @@ MEMORY_ADDRESSES = {
     "bag_items": 0xD31E,  # Item ID, quantity pairs
 }
 
+# Every address above except the per-Pokemon offsets lies in this WRAM
+# window, so update_game_state copies it once and indexes the copy
+WRAM_BASE = 0xCFE5  # enemy_pokemon_species
+WRAM_END = 0xD363  # exclusive, one past player_x
+WORK_RAM_START = 0xC000  # start of the Game Boy's 8 KB work RAM
+
+# Offsets of the tracked fields within the WRAM copy, resolved once here
+# rather than with a dict lookup and a subtraction per field per update
+PARTY_COUNT_OFFSET = MEMORY_ADDRESSES["party_count"] - WRAM_BASE
+PARTY_SPECIES_OFFSET = MEMORY_ADDRESSES["party_species"] - WRAM_BASE
+PARTY_DATA_OFFSET = MEMORY_ADDRESSES["party_data"] - WRAM_BASE
+BADGES_OFFSET = MEMORY_ADDRESSES["badges"] - WRAM_BASE
+MAP_ID_OFFSET = MEMORY_ADDRESSES["map_id"] - WRAM_BASE
+BATTLE_TYPE_OFFSET = MEMORY_ADDRESSES["battle_type"] - WRAM_BASE
+ENEMY_SPECIES_OFFSET = MEMORY_ADDRESSES["enemy_pokemon_species"] - WRAM_BASE
+ENEMY_LEVEL_OFFSET = MEMORY_ADDRESSES["enemy_pokemon_level"] - WRAM_BASE
+ENEMY_HP_OFFSET = MEMORY_ADDRESSES["enemy_pokemon_hp"] - WRAM_BASE
+BAG_ITEMS_COUNT_OFFSET = MEMORY_ADDRESSES["bag_items_count"] - WRAM_BASE
+BAG_ITEMS_OFFSET = MEMORY_ADDRESSES["bag_items"] - WRAM_BASE
+
+# get_state reuses the last state for up to this many frames while the map,
+# party size and battle type are unchanged (any button press ticks past it)
+STATE_REUSE_FRAMES = 5
+
+# Decimal value of each packed-BCD byte, for decoding money
+BCD_TABLE = bytes((i >> 4) * 10 + (i & 0xF) for i in range(256))
+
+# A little-endian 16-bit word, as stored for HP values
+WORD = struct.Struct("<H")
+
+# A 44-byte party Pokemon record, unpacked to (current HP, level, max HP)
+# from the pokemon_hp, pokemon_level and pokemon_max_hp offsets above
+PARTY_RECORD = struct.Struct("<xH30xBH8x")
+
 # Pokemon species names (index 0 is unused, species start at 1)
 POKEMON_NAMES = {
     0: "???", 1: "RHYDON", 2: "KANGASKHAN", 3: "NIDORAN♂", 4: "CLEFAIRY",
@@ -130,6 +166,12 @@ ITEM_NAMES = {
     81: "MAX ETHER", 82: "ELIXER", 83: "MAX ELIXER",
 }
 
+# Every ID is one byte, so update_game_state resolves names by indexing
+# these tables; unknown IDs get the same fallback names as before
+POKEMON_NAME_TABLE = [POKEMON_NAMES.get(i, f"Pokemon #{i}") for i in range(256)]
+MAP_NAME_TABLE = [MAP_NAMES.get(i, f"Map #{i}") for i in range(256)]
+ITEM_NAME_TABLE = [ITEM_NAMES.get(i, f"Item #{i}") for i in range(256)]
+
 # Define button mapping
 BUTTON_MAP = {
     "a": WindowEvent.PRESS_BUTTON_A,
@@ -153,6 +195,12 @@ BUTTON_RELEASE_MAP = {
     "right": WindowEvent.RELEASE_ARROW_RIGHT
 }
 
+# One dict lookup maps an action to its index; the press and release
+# events are then plain tuple lookups
+ACTION_IDS = {action: i for i, action in enumerate(BUTTON_MAP)}
+PRESS_EVENTS = tuple(BUTTON_MAP.values())
+RELEASE_EVENTS = tuple(BUTTON_RELEASE_MAP[action] for action in BUTTON_MAP)
+
 class PokemonEmulator:
     def __init__(self, rom_path, rom_name=None):
         """Initialize the Pokemon emulator with the specified ROM."""
@@ -164,10 +212,15 @@ class PokemonEmulator:
         self.rom_name = rom_name or "Unknown"
         self.pyboy = PyBoy(rom_path, game_wrapper=True)
         self.game = self.pyboy.game_wrapper()
-        self.screen_buffer = []
+        self._wram_view = self._resolve_wram_view()
         self.last_screenshot = None
+        self._screenshot_frame = -1  # frame_count at which last_screenshot was taken
         self.frame_count = 0
         self.is_running = False
+        self._tick_callbacks = []
+        self._pending_releases = deque()  # (frame_count, release event), in frame order
+        self._state_key = None  # (map_id, party_count, battle_type) of current_state
+        self._state_frame = -STATE_REUSE_FRAMES
 
         # Game state tracking
         self.current_state = {
@@ -197,12 +250,34 @@ class PokemonEmulator:
     
     def get_screenshot(self):
         """Get the current screenshot of the game."""
+        # Repeat calls within one frame share the image instead of rebuilding it
+        if self._screenshot_frame == self.frame_count:
+            return self.last_screenshot
         screen_image = self.pyboy.screen_image()
         self.last_screenshot = screen_image
+        self._screenshot_frame = self.frame_count
         return screen_image
     
+    def frame_hash(self):
+        """Checksum of the current screen, for cheaply spotting unchanged frames."""
+        screen = getattr(self.pyboy, "screen", None)
+        if screen is not None:
+            # Hash PyBoy's frame buffer in place, without building an image
+            return zlib.crc32(np.ascontiguousarray(screen.ndarray))
+        return zlib.crc32(np.asarray(self.get_screenshot()))
+    
     def get_screen_ndarray(self):
-        """Get the current screen as a numpy array."""
+        """
+        Get the current screen as a (144, 160, 3) RGB numpy array.
+
+        Where PyBoy exposes its frame buffer this is a read-only view into it,
+        with no copy, that follows later ticks; copy() it to keep a frame.
+        """
+        screen = getattr(self.pyboy, "screen", None)
+        if screen is not None:
+            view = screen.ndarray[:, :, :3]
+            view.flags.writeable = False
+            return view
         return np.array(self.get_screenshot())
     
     def save_screenshot(self, path):
@@ -212,20 +287,39 @@ class PokemonEmulator:
     
     def execute_action(self, action):
         """Execute a game action (button press)."""
-        if action not in BUTTON_MAP:
+        idx = ACTION_IDS.get(action)
+        if idx is None:
             logger.warning(f"Unknown action: {action}")
             return False
         
-        logger.info(f"Executing action: {action}")
-        self.pyboy.send_input(BUTTON_MAP[action])
+        logger.debug("Executing action: %s", action)
+        self.pyboy.send_input(PRESS_EVENTS[idx])
         self.tick(5)  # Small delay after button press
-        self.pyboy.send_input(BUTTON_RELEASE_MAP[action])
+        self.pyboy.send_input(RELEASE_EVENTS[idx])
         self.tick(5)  # Small delay after button release
         return True
     
+    def press_action(self, action, hold_frames=5):
+        """
+        Press a button without advancing the emulator.
+
+        The release is sent by tick() once hold_frames more frames have run,
+        so whoever drives the emulator (the game loop in app.py) does the
+        frame stepping and the caller returns immediately.
+        """
+        idx = ACTION_IDS.get(action)
+        if idx is None:
+            logger.warning(f"Unknown action: {action}")
+            return False
+
+        logger.debug("Pressing: %s", action)
+        self.pyboy.send_input(PRESS_EVENTS[idx])
+        self._pending_releases.append((self.frame_count + hold_frames, RELEASE_EVENTS[idx]))
+        return True
+    
     def execute_sequence(self, actions, delay=10):
         """Execute a sequence of actions with delays between them."""
-        logger.info(f"Executing sequence: {actions}")
+        logger.info("Executing sequence: %s", actions)
         results = []
         for action in actions:
             result = self.execute_action(action)
@@ -233,11 +327,21 @@ class PokemonEmulator:
             self.tick(delay)
         return results
     
+    def on_tick(self, callback, every=1):
+        """Call callback(emulator) after every `every` emulated frames."""
+        self._tick_callbacks.append((every, callback))
+
     def tick(self, frames=1):
         """Advance the emulator by a number of frames."""
         for _ in range(frames):
             self.pyboy.tick()
             self.frame_count += 1
+            pending = self._pending_releases
+            while pending and pending[0][0] <= self.frame_count:
+                self.pyboy.send_input(pending.popleft()[1])
+            for every, callback in self._tick_callbacks:
+                if self.frame_count % every == 0:
+                    callback(self)
 
     def run_for_seconds(self, seconds):
         """Run the emulator for a specified number of seconds."""
@@ -246,142 +350,116 @@ class PokemonEmulator:
         logger.info(f"Running for {seconds} seconds ({frames} frames)")
         self.tick(frames)
     
+    def _resolve_wram_view(self):
+        """
+        A zero-copy numpy view of work RAM (0xC000-0xDFFF), or None.
+
+        This reaches into PyBoy internals, so it is only used after a probe
+        write through pyboy.memory shows up in the view; any PyBoy version
+        that doesn't expose its RAM this way keeps using pyboy.memory.
+        """
+        try:
+            view = np.frombuffer(self.pyboy.mb.ram.internal_ram0, dtype=np.uint8)
+            if view.size < 0x2000:
+                return None
+            probe = WRAM_END  # outside everything update_game_state reads
+            original = self.pyboy.memory[probe]
+            self.pyboy.memory[probe] = original ^ 0xFF
+            live = view[probe - WORK_RAM_START] == original ^ 0xFF
+            self.pyboy.memory[probe] = original
+        except Exception:
+            return None
+        if not live:
+            return None
+        logger.info("Reading game state through a direct work RAM view")
+        return view
+
     def _read_memory(self, address):
         """Read a single byte from game memory."""
         try:
+            if self._wram_view is not None and WORK_RAM_START <= address < WORK_RAM_START + 0x2000:
+                return int(self._wram_view[address - WORK_RAM_START])
             return self.pyboy.memory[address]
         except Exception as e:
-            logger.warning(f"Failed to read memory at {hex(address)}: {e}")
+            logger.warning("Failed to read memory at %#x: %s", address, e)
             return 0
 
-    def _read_memory_word(self, address):
-        """Read a 16-bit word from game memory (little-endian)."""
+    def _read_wram(self):
+        """Copy the WRAM window holding all tracked game state in one read."""
+        if self._wram_view is not None:
+            # A single C-level memcpy out of PyBoy's RAM
+            return self._wram_view[WRAM_BASE - WORK_RAM_START:WRAM_END - WORK_RAM_START].tobytes()
         try:
-            low = self.pyboy.memory[address]
-            high = self.pyboy.memory[address + 1]
-            return (high << 8) | low
+            return bytes(self.pyboy.memory[WRAM_BASE:WRAM_END])
         except Exception as e:
-            logger.warning(f"Failed to read word at {hex(address)}: {e}")
-            return 0
+            logger.warning(f"Bulk WRAM read failed, reading byte by byte: {e}")
+            return bytes(self._read_memory(address) for address in range(WRAM_BASE, WRAM_END))
 
-    def _read_bcd_money(self, address):
-        """Read BCD-encoded money value (3 bytes)."""
-        try:
-            b1 = self.pyboy.memory[address]
-            b2 = self.pyboy.memory[address + 1]
-            b3 = self.pyboy.memory[address + 2]
-            # BCD decoding
-            money = ((b1 >> 4) * 100000 + (b1 & 0xF) * 10000 +
-                     (b2 >> 4) * 1000 + (b2 & 0xF) * 100 +
-                     (b3 >> 4) * 10 + (b3 & 0xF))
-            return money
-        except Exception as e:
-            logger.warning(f"Failed to read BCD money: {e}")
-            return 0
-
-    def _get_pokemon_name(self, species_id):
-        """Get Pokemon name from species ID."""
-        return POKEMON_NAMES.get(species_id, f"Pokemon #{species_id}")
-
-    def _get_location_name(self, map_id):
-        """Get location name from map ID."""
-        return MAP_NAMES.get(map_id, f"Map #{map_id}")
-
-    def _get_item_name(self, item_id):
-        """Get item name from item ID."""
-        return ITEM_NAMES.get(item_id, f"Item #{item_id}")
-
-    def _count_badges(self, badge_byte):
-        """Count number of badges from badge bit flags."""
-        count = 0
-        for i in range(8):
-            if badge_byte & (1 << i):
-                count += 1
-        return count
+    def _read_bcd_money(self, wram, address):
+        """Read BCD-encoded money value (3 bytes) from a WRAM copy."""
+        i = address - WRAM_BASE
+        return BCD_TABLE[wram[i]] * 10000 + BCD_TABLE[wram[i + 1]] * 100 + BCD_TABLE[wram[i + 2]]
 
     def update_game_state(self):
         """Update the game state by reading from game memory."""
         try:
+            # One copy of the WRAM window; everything below indexes it
+            wram = self._read_wram()
+
             # Read party Pokemon
-            party_count = self._read_memory(MEMORY_ADDRESSES["party_count"])
-            party_count = min(party_count, 6)  # Max 6 Pokemon
+            party_count = min(wram[PARTY_COUNT_OFFSET], 6)  # Max 6 Pokemon
+
+            # Species come from the party species list; the fixed-size
+            # records are unpacked in C in one pass
+            records = PARTY_RECORD.iter_unpack(
+                wram[PARTY_DATA_OFFSET:PARTY_DATA_OFFSET + party_count * PARTY_RECORD.size])
 
             pokemon_team = []
-            if party_count > 0:
-                for i in range(party_count):
-                    # Read species from party species list
-                    species_id = self._read_memory(MEMORY_ADDRESSES["party_species"] + i)
-
-                    # Read Pokemon data (44 bytes per Pokemon)
-                    base_addr = MEMORY_ADDRESSES["party_data"] + (i * 44)
-
-                    # Read HP (2 bytes at offset 1)
-                    current_hp = self._read_memory_word(base_addr + 1)
-                    # Read level (1 byte at offset 33)
-                    level = self._read_memory(base_addr + 33)
-                    # Read max HP (2 bytes at offset 34)
-                    max_hp = self._read_memory_word(base_addr + 34)
-
-                    # Sanity check values
-                    if level == 0:
-                        level = 1
-                    if max_hp == 0:
-                        max_hp = 1
-                    if current_hp > max_hp:
-                        current_hp = max_hp
-
-                    pokemon_name = self._get_pokemon_name(species_id)
-
-                    pokemon_team.append({
-                        "name": pokemon_name,
-                        "level": level,
-                        "hp": current_hp,
-                        "max_hp": max_hp,
-                        "species_id": species_id
-                    })
+            for species_id, (current_hp, level, max_hp) in zip(
+                    wram[PARTY_SPECIES_OFFSET:PARTY_SPECIES_OFFSET + party_count], records):
+                # Sanity check values
+                level = level or 1
+                max_hp = max_hp or 1
+
+                pokemon_team.append({
+                    "name": POKEMON_NAME_TABLE[species_id],
+                    "level": level,
+                    "hp": min(current_hp, max_hp),
+                    "max_hp": max_hp,
+                    "species_id": species_id
+                })
 
             # Read location
-            map_id = self._read_memory(MEMORY_ADDRESSES["map_id"])
-            location = self._get_location_name(map_id)
+            map_id = wram[MAP_ID_OFFSET]
+            location = MAP_NAME_TABLE[map_id]
 
             # Read badges
-            badge_byte = self._read_memory(MEMORY_ADDRESSES["badges"])
-            badges = self._count_badges(badge_byte)
+            badges = wram[BADGES_OFFSET].bit_count()
 
             # Read money
-            money = self._read_bcd_money(MEMORY_ADDRESSES["money"])
+            money = self._read_bcd_money(wram, MEMORY_ADDRESSES["money"])
 
-            # Read items
-            items = []
-            item_count = self._read_memory(MEMORY_ADDRESSES["bag_items_count"])
-            item_count = min(item_count, 20)  # Reasonable limit
+            # Read items: (item ID, quantity) byte pairs
+            item_count = min(wram[BAG_ITEMS_COUNT_OFFSET], 20)  # Reasonable limit
+            bag = iter(wram[BAG_ITEMS_OFFSET:BAG_ITEMS_OFFSET + item_count * 2])
 
-            for i in range(item_count):
-                item_addr = MEMORY_ADDRESSES["bag_items"] + (i * 2)
-                item_id = self._read_memory(item_addr)
-                item_qty = self._read_memory(item_addr + 1)
-
-                if item_id > 0 and item_id != 0xFF:
-                    items.append({
-                        "name": self._get_item_name(item_id),
-                        "count": item_qty,
-                        "id": item_id
-                    })
+            items = [
+                {"name": ITEM_NAME_TABLE[item_id], "count": item_qty, "id": item_id}
+                for item_id, item_qty in zip(bag, bag)
+                if item_id > 0 and item_id != 0xFF
+            ]
 
             # Check battle state
-            battle_type = self._read_memory(MEMORY_ADDRESSES["battle_type"])
+            battle_type = wram[BATTLE_TYPE_OFFSET]
             in_battle = battle_type > 0
 
             # Build enemy info if in battle
             enemy_info = None
             if in_battle:
-                enemy_species = self._read_memory(MEMORY_ADDRESSES["enemy_pokemon_species"])
-                enemy_level = self._read_memory(MEMORY_ADDRESSES["enemy_pokemon_level"])
-                enemy_hp = self._read_memory_word(MEMORY_ADDRESSES["enemy_pokemon_hp"])
                 enemy_info = {
-                    "name": self._get_pokemon_name(enemy_species),
-                    "level": enemy_level,
-                    "hp": enemy_hp,
+                    "name": POKEMON_NAME_TABLE[wram[ENEMY_SPECIES_OFFSET]],
+                    "level": wram[ENEMY_LEVEL_OFFSET],
+                    "hp": WORD.unpack_from(wram, ENEMY_HP_OFFSET)[0],
                     "battle_type": "wild" if battle_type == 1 else "trainer"
                 }
 
@@ -400,7 +478,7 @@ class PokemonEmulator:
                 "party_count": party_count
             }
 
-            logger.debug(f"Game state updated: {location}, {party_count} Pokemon, {badges} badges")
+            logger.debug("Game state updated: %s, %d Pokemon, %d badges", location, party_count, badges)
 
         except Exception as e:
             logger.error(f"Error updating game state: {e}")
@@ -420,9 +498,16 @@ class PokemonEmulator:
         return self.current_state
     
     def get_state(self):
-        """Get the current game state."""
-        self.update_game_state()
-        return self.current_state
+        """Get a snapshot of the current game state, safe for callers to modify."""
+        # Three bytes decide whether the last full read is still good enough
+        key = (self._read_memory(MEMORY_ADDRESSES["map_id"]),
+               self._read_memory(MEMORY_ADDRESSES["party_count"]),
+               self._read_memory(MEMORY_ADDRESSES["battle_type"]))
+        if key != self._state_key or self.frame_count >= self._state_frame + STATE_REUSE_FRAMES:
+            self.update_game_state()
+            self._state_key = key
+            self._state_frame = self.frame_count
+        return dict(self.current_state)
     
     def detect_game_screen(self):
         """Detect what screen we're currently on (battle, overworld, menu, etc.)."""
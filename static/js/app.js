@@ -217,7 +217,8 @@ function updateAPIStatus(isAvailable) {
 
 // Action Log Functions
 function fetchActionLog() {
-    fetch('/api/action_log')
+    // Only the newest 20 entries are shown, so don't pull the whole log
+    fetch('/api/action_log?limit=20')
         .then(response => response.json())
         .then(data => {
             updateActionLog(data);
@@ -610,11 +611,27 @@ socket.on('disconnect', () => {
     addCommentary('Disconnected from server. Trying to reconnect...');
 });
 
+let screenObjectUrl = null;
+
 socket.on('screenshot_update', (data) => {
-    gameScreen.src = `data:image/png;base64,${data.image}`;
+    const format = data.format || 'png';
+    if (typeof data.image === 'string') {
+        gameScreen.src = `data:image/${format};base64,${data.image}`;
+        return;
+    }
+
+    // Binary frame: show it through an object URL, freeing the previous one
+    const url = URL.createObjectURL(new Blob([data.image], { type: `image/${format}` }));
+    gameScreen.src = url;
+    if (screenObjectUrl) {
+        URL.revokeObjectURL(screenObjectUrl);
+    }
+    screenObjectUrl = url;
 });
 
-socket.on('state_update', (data) => {
+socket.on('state_update', (payload) => {
+    // The server sends the state pre-serialized as JSON text
+    const data = typeof payload === 'string' ? JSON.parse(payload) : payload;
     updatePokemonTeam(data.pokemon_team);
     updateItemsList(data.items);
     locationEl.textContent = data.location || 'Unknown';
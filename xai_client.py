@@ -5,41 +5,216 @@ This module handles communication with the xAI API for game decisions.
 """
 
 import os
+import asyncio
 import base64
+import hashlib
 import logging
 import json
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
 from io import BytesIO
 from dotenv import load_dotenv
+from PIL import Image
+
+from api.shared import extract_json_object
 
 # Load environment variables
 load_dotenv()
 
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Set up logging (handlers are configured by the app entry point)
 logger = logging.getLogger(__name__)
 
+# Encoded screenshots kept per client; the action request and the screen
+# analysis usually send the same frame
+ENCODED_IMAGE_CACHE_SIZE = 4
+
+# Native Game Boy resolution; larger frames are upscaled copies, so they
+# are shrunk back before encoding (2x is still accepted as-is)
+SCREEN_SIZE = (160, 144)
+MAX_UPLOAD_WIDTH = SCREEN_SIZE[0] * 2
+
+# Upper bound on requests in flight when sampling several actions at once
+MAX_CONCURRENT_REQUESTS = 10
+
+# A repeated frame reuses the previous screen analysis for this long; after
+# that it is analyzed again in case only animated tiles kept it identical
+ANALYSIS_CACHE_SECONDS = 30.0
+
+# Connection pool shared by all requests from one client
+HTTP_MAX_CONNECTIONS = 32
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 16
+
+# Transient API failures (rate limits, timeouts, 5xx) are retried this many
+# times in total, sleeping RETRY_BASE_DELAY * 2**attempt plus jitter between
+API_MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.5
+
+# Buttons Grok may choose
+VALID_ACTIONS = frozenset({"a", "b", "up", "down", "left", "right", "start", "select"})
+
+# Fallback for replies without JSON: the first button named as a whole word,
+# found in one scan of the reply
+ACTION_WORD_RE = re.compile(r'\b(up|down|left|right|start|select|a|b)\b')
+
+# System prompts are fixed, so they are built once; byte-identical prompts
+# across calls also let the server reuse its prompt cache
+SYSTEM_PROMPT = """You are Grok, an AI playing Pokemon Red/Blue/Yellow on a Game Boy. Your goal is to complete the game - catch Pokemon, defeat gym leaders, and become the Pokemon Champion.
+
+You can see the game screen and must decide what button to press next. The available buttons are:
+- a: Confirm/Select/Talk/Interact
+- b: Cancel/Back/Run
+- up, down, left, right: Movement/Menu navigation
+- start: Open menu
+- select: Rarely used
+
+IMPORTANT GUIDELINES:
+1. Look at the screen carefully to understand the current situation
+2. In menus, navigate to the correct option before pressing A
+3. During battles, consider type advantages and Pokemon health
+4. Explore thoroughly but don't get stuck in loops
+5. Talk to NPCs for hints and story progression
+6. Save the game periodically (Start -> Save)
+7. Heal Pokemon at Pokemon Centers when needed
+8. Catch wild Pokemon to build your team
+
+RESPONSE FORMAT:
+You must respond with a JSON object containing:
+{
+    "action": "button_name",
+    "commentary": "Your reasoning (1-2 sentences max)",
+    "confidence": 0.0-1.0
+}
+
+Only output the JSON, nothing else."""
+
+ANALYSIS_PROMPT = """Analyze this Pokemon game screenshot and identify:
+1. The screen type (battle, overworld, menu, dialogue, title, pokemon_center, pokemart, cave, building, route)
+2. Brief description of what's happening
+3. Any important details (enemy Pokemon, menu options, NPC text, etc.)
+
+Respond with JSON only:
+{
+    "screen_type": "type",
+    "description": "brief description",
+    "details": "important details",
+    "suggested_context": "context for next action"
+}"""
+
+COMBINED_PROMPT = SYSTEM_PROMPT + """
+
+For this turn, also analyze the screen:
+1. The screen type (battle, overworld, menu, dialogue, title, pokemon_center, pokemart, cave, building, route)
+2. Brief description of what's happening
+3. Any important details (enemy Pokemon, menu options, NPC text, etc.)
+
+This replaces the response format above. Respond with one JSON object only:
+{
+    "analysis": {
+        "screen_type": "type",
+        "description": "brief description",
+        "details": "important details",
+        "suggested_context": "context for next action"
+    },
+    "decision": {
+        "action": "button_name",
+        "commentary": "Your reasoning (1-2 sentences max)",
+        "confidence": 0.0-1.0
+    }
+}"""
+
+
+def format_team_line(team):
+    """Format the party for the user prompt."""
+    return "- Team: " + ", ".join([f"{p['name']} Lv{p['level']} ({p['hp']}/{p['max_hp']} HP)"
+                                   for p in team])
+
+
+# Game-state fields shown in the user prompt, in order, with their formatters
+PROMPT_FIELDS = (
+    ("location", "- Location: {}".format),
+    ("pokemon_team", format_team_line),
+    ("badges", "- Badges: {}/8".format),
+    ("money", "- Money: ${}".format),
+)
+
+# Upload formats: PIL format name, MIME type and save options. JPEG at high
+# quality encodes several times faster than PNG's deflate and yields a
+# smaller payload; the Game Boy screen tolerates the artifacts well.
+IMAGE_FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg", {"quality": 85, "optimize": False}),
+    "png": ("PNG", "image/png", {}),
+}
+
 # Try to import openai (xAI uses OpenAI-compatible API)
 try:
-    from openai import OpenAI
+    from openai import OpenAI, AsyncOpenAI
+    from openai import APIStatusError, APITimeoutError, RateLimitError
+    import httpx  # installed with openai
     OPENAI_AVAILABLE = True
 except ImportError:
     OPENAI_AVAILABLE = False
     logger.warning("OpenAI package not available. Install with: pip install openai")
 
+# Try to import h2 (lets httpx multiplex requests over one HTTP/2 connection)
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Try to import pybase64 (SIMD base64, same interface as the stdlib module)
+try:
+    import pybase64
+    PYBASE64_AVAILABLE = True
+except ImportError:
+    PYBASE64_AVAILABLE = False
+
+b64encode = pybase64.b64encode if PYBASE64_AVAILABLE else base64.b64encode
+
+# Try to import orjson (faster parsing of the JSON in API replies)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# orjson accepts str input and its decode error subclasses ValueError too
+json_loads = orjson.loads if ORJSON_AVAILABLE else json.loads
+
+
 
 class XAIClient:
     """Client for interacting with xAI's Grok API."""
 
-    def __init__(self, api_key=None):
+    __slots__ = ("api_key", "client", "async_client", "image_format",
+                 "_encoded_images", "_encoded_images_lock", "_encode_local",
+                 "_last_analysis", "_last_analysis_url", "_last_analysis_time")
+
+    model = "grok-2-vision-1212"  # Grok model with vision capabilities
+
+    def __init__(self, api_key=None, image_format="jpeg"):
         """
         Initialize the xAI client.
 
         Args:
             api_key: xAI API key. If not provided, will try to get from environment.
+            image_format: Screenshot upload format, "jpeg" (default) or "png"
         """
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unsupported image format: {image_format}")
         self.api_key = api_key or os.getenv('XAI_API_KEY')
         self.client = None
-        self.model = "grok-2-vision-1212"  # Grok model with vision capabilities
+        self.async_client = None  # Same endpoint, for concurrent requests
+        self.image_format = image_format
+        self._encoded_images = OrderedDict()  # pixel digest -> data URL, most recent last
+        self._encoded_images_lock = threading.Lock()
+        self._encode_local = threading.local()  # per-thread reusable BytesIO
+        self._last_analysis = None  # Screen analysis of the last analyzed frame
+        self._last_analysis_url = None  # Its image data URL, which identifies the pixels
+        self._last_analysis_time = 0.0
 
         if not OPENAI_AVAILABLE:
             logger.error("OpenAI package not installed. Cannot initialize xAI client.")
@@ -49,10 +224,23 @@ class XAIClient:
             logger.warning("No xAI API key provided. Set XAI_API_KEY environment variable.")
             return
 
-        # Initialize the OpenAI client with xAI base URL
+        # Initialize the OpenAI client with xAI base URL, on explicitly pooled
+        # connections so the TLS handshake is paid once rather than per turn
+        limits = httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS
+        )
         self.client = OpenAI(
             api_key=self.api_key,
-            base_url="https://api.x.ai/v1"
+            base_url="https://api.x.ai/v1",
+            max_retries=0,  # _call_with_retry owns the retry policy
+            http_client=httpx.Client(http2=HTTP2_AVAILABLE, limits=limits)
+        )
+        self.async_client = AsyncOpenAI(
+            api_key=self.api_key,
+            base_url="https://api.x.ai/v1",
+            max_retries=0,  # _call_with_retry owns the retry policy
+            http_client=httpx.AsyncClient(http2=HTTP2_AVAILABLE, limits=limits)
         )
         logger.info("xAI client initialized successfully")
 
@@ -60,6 +248,11 @@ class XAIClient:
         """Check if the xAI client is properly configured."""
         return self.client is not None and self.api_key is not None
 
+    @property
+    def image_mime_type(self):
+        """MIME type of the images produced by encode_image."""
+        return IMAGE_FORMATS[self.image_format][1]
+
     def encode_image(self, image):
         """
         Encode a PIL image to base64 for API submission.
@@ -70,9 +263,56 @@ class XAIClient:
         Returns:
             Base64 encoded string of the image
         """
-        buffered = BytesIO()
-        image.save(buffered, format="PNG")
-        return base64.b64encode(buffered.getvalue()).decode('utf-8')
+        pil_format, _, save_options = IMAGE_FORMATS[self.image_format]
+        if image.mode != "RGB":
+            image = image.convert("RGB")  # no-op for frames from image_data_url
+        buffered = getattr(self._encode_local, "buffer", None)
+        if buffered is None:
+            buffered = self._encode_local.buffer = BytesIO()
+        buffered.seek(0)
+        buffered.truncate()
+        image.save(buffered, format=pil_format, **save_options)
+        # getbuffer() hands the encoder a view instead of copying the bytes;
+        # it must be released before the buffer can be truncated again
+        with buffered.getbuffer() as view:
+            return b64encode(view).decode('ascii')
+
+    def image_data_url(self, image):
+        """
+        Get the data URL that carries a screenshot in an API request.
+
+        The action request, the screen analysis and repeated static screens
+        usually send the same frame, so the finished URL is kept in a small
+        LRU keyed by the pixels and each frame is encoded and assembled once.
+
+        Args:
+            image: PIL Image object
+
+        Returns:
+            data: URL string with the base64 encoded image
+        """
+        # Encode and payload cost scale with pixel count; NEAREST is a plain
+        # pixel pick, exact for integer upscales
+        if image.width > MAX_UPLOAD_WIDTH:
+            image = image.resize(SCREEN_SIZE, Image.NEAREST)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+        # Hashing the raw pixels is far cheaper than compressing them again
+        key = hashlib.blake2b(image.tobytes(), digest_size=16).digest()
+        with self._encoded_images_lock:
+            url = self._encoded_images.get(key)
+            if url is not None:
+                self._encoded_images.move_to_end(key)
+                return url
+
+        url = f"data:{self.image_mime_type};base64,{self.encode_image(image)}"
+
+        with self._encoded_images_lock:
+            self._encoded_images[key] = url
+            if len(self._encoded_images) > ENCODED_IMAGE_CACHE_SIZE:
+                self._encoded_images.popitem(last=False)
+        return url
 
     def get_game_action(self, screenshot, game_state, recent_actions=None, context=None):
         """
@@ -98,98 +338,208 @@ class XAIClient:
                 "confidence": 0.0
             }
 
-        # Encode the screenshot
-        image_base64 = self.encode_image(screenshot)
-
-        # Build the prompt
-        system_prompt = self._build_system_prompt()
-        user_prompt = self._build_user_prompt(game_state, recent_actions, context)
+        request = self._game_action_request(screenshot, game_state, recent_actions, context)
 
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": system_prompt
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": user_prompt
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/png;base64,{image_base64}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=500,
-                temperature=0.7
-            )
+            response_text = self._stream_reply(**request)
 
             # Parse the response
-            return self._parse_response(response.choices[0].message.content)
+            return self._parse_response(response_text)
 
         except Exception as e:
-            logger.error(f"Error calling xAI API: {e}")
+            logger.error("Error calling xAI API: %s", e)
             return {
                 "action": "a",
                 "commentary": f"API error: {str(e)[:100]}",
                 "confidence": 0.0
             }
 
-    def _build_system_prompt(self):
-        """Build the system prompt for Grok."""
-        return """You are Grok, an AI playing Pokemon Red/Blue/Yellow on a Game Boy. Your goal is to complete the game - catch Pokemon, defeat gym leaders, and become the Pokemon Champion.
+    async def get_game_action_async(self, screenshot, game_state, recent_actions=None, context=None):
+        """
+        Async variant of get_game_action, so several requests can overlap.
 
-You can see the game screen and must decide what button to press next. The available buttons are:
-- a: Confirm/Select/Talk/Interact
-- b: Cancel/Back/Run
-- up, down, left, right: Movement/Menu navigation
-- start: Open menu
-- select: Rarely used
+        Takes the same arguments and returns the same dictionary.
+        """
+        if not self.is_available():
+            logger.warning("xAI client not available, returning default action")
+            return {
+                "action": "a",
+                "commentary": "xAI API not configured - using default action",
+                "confidence": 0.0
+            }
 
-IMPORTANT GUIDELINES:
-1. Look at the screen carefully to understand the current situation
-2. In menus, navigate to the correct option before pressing A
-3. During battles, consider type advantages and Pokemon health
-4. Explore thoroughly but don't get stuck in loops
-5. Talk to NPCs for hints and story progression
-6. Save the game periodically (Start -> Save)
-7. Heal Pokemon at Pokemon Centers when needed
-8. Catch wild Pokemon to build your team
+        request = self._game_action_request(screenshot, game_state, recent_actions, context)
 
-RESPONSE FORMAT:
-You must respond with a JSON object containing:
-{
-    "action": "button_name",
-    "commentary": "Your reasoning (1-2 sentences max)",
-    "confidence": 0.0-1.0
-}
+        try:
+            response_text = await self._stream_reply_async(**request)
+            return self._parse_response(response_text)
 
-Only output the JSON, nothing else."""
+        except Exception as e:
+            logger.error("Error calling xAI API: %s", e)
+            return {
+                "action": "a",
+                "commentary": f"API error: {str(e)[:100]}",
+                "confidence": 0.0
+            }
+
+    async def sample_game_actions(self, screenshot, game_state, recent_actions=None, context=None, samples=3):
+        """
+        Request several independent actions for the same turn concurrently.
+
+        Useful for majority voting. At most MAX_CONCURRENT_REQUESTS calls are
+        in flight at once.
+
+        Returns:
+            List of action dictionaries, one per sample
+        """
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+        async def sample():
+            async with semaphore:
+                return await self.get_game_action_async(screenshot, game_state, recent_actions, context)
+
+        return await asyncio.gather(*(sample() for _ in range(samples)))
+
+    @staticmethod
+    def _is_transient(error):
+        """Whether an API error is worth retrying (rate limit, timeout, 5xx)."""
+        if isinstance(error, (RateLimitError, APITimeoutError)):
+            return True
+        return isinstance(error, APIStatusError) and error.status_code >= 500
+
+    @staticmethod
+    def _retry_delay(attempt):
+        """Exponential backoff with jitter before retry number attempt + 1."""
+        return RETRY_BASE_DELAY * 2 ** attempt + random.uniform(0, RETRY_BASE_DELAY)
+
+    def _call_with_retry(self, max_attempts=API_MAX_ATTEMPTS, **request):
+        """
+        Call chat.completions.create, retrying transient failures.
+
+        Other errors, and the last transient one, are raised to the caller.
+        """
+        for attempt in range(max_attempts):
+            try:
+                return self.client.chat.completions.create(**request)
+            except Exception as e:
+                if attempt == max_attempts - 1 or not self._is_transient(e):
+                    raise
+                delay = self._retry_delay(attempt)
+                logger.warning("Transient xAI API error (%s), retrying in %.1fs", e, delay)
+                time.sleep(delay)
+
+    async def _call_with_retry_async(self, max_attempts=API_MAX_ATTEMPTS, **request):
+        """Async variant of _call_with_retry using the async client."""
+        for attempt in range(max_attempts):
+            try:
+                return await self.async_client.chat.completions.create(**request)
+            except Exception as e:
+                if attempt == max_attempts - 1 or not self._is_transient(e):
+                    raise
+                delay = self._retry_delay(attempt)
+                logger.warning("Transient xAI API error (%s), retrying in %.1fs", e, delay)
+                await asyncio.sleep(delay)
+
+    def _stream_reply(self, **request):
+        """
+        Stream a completion and return its text.
+
+        Reading stops, and the connection is closed, as soon as the text holds
+        a complete JSON object, so trailing commentary is neither waited for
+        nor generated.
+        """
+        stream = self._call_with_retry(stream=True, **request)
+        parts = []
+        try:
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                parts.append(delta)
+                if '}' in delta and extract_json_object(''.join(parts)) is not None:
+                    break
+        finally:
+            stream.close()
+        return ''.join(parts)
+
+    async def _stream_reply_async(self, **request):
+        """Async variant of _stream_reply using the async client."""
+        stream = await self._call_with_retry_async(stream=True, **request)
+        parts = []
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                parts.append(delta)
+                if '}' in delta and extract_json_object(''.join(parts)) is not None:
+                    break
+        finally:
+            await stream.close()
+        return ''.join(parts)
+
+    def _game_action_request(self, screenshot, game_state, recent_actions=None, context=None):
+        """Build the chat.completions.create arguments for an action request."""
+        # Encode the screenshot
+        image_url = self.image_data_url(screenshot)
+
+        # Build the prompt
+        system_prompt = self._build_system_prompt()
+        user_prompt = self._build_user_prompt(game_state, recent_actions, context)
+
+        return {
+            "model": self.model,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": system_prompt
+                },
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": user_prompt
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": image_url
+                            }
+                        }
+                    ]
+                }
+            ],
+            "max_tokens": 80,  # the decision JSON is well under this
+            "temperature": 0.2,
+            "response_format": {"type": "json_object"}
+        }
+
+    def _build_system_prompt(self):
+        """Build the system prompt for Grok."""
+        return SYSTEM_PROMPT
+
+    def _build_analysis_prompt(self):
+        """Build the system prompt for screen analysis."""
+        return ANALYSIS_PROMPT
+
+    def _build_combined_prompt(self):
+        """Build the system prompt asking for an analysis and an action at once."""
+        return COMBINED_PROMPT
 
     def _build_user_prompt(self, game_state, recent_actions=None, context=None):
         """Build the user prompt with game state information."""
         prompt_parts = ["Current game state:"]
 
         if game_state:
-            if game_state.get("location"):
-                prompt_parts.append(f"- Location: {game_state['location']}")
-            if game_state.get("pokemon_team"):
-                team_str = ", ".join([f"{p['name']} Lv{p['level']} ({p['hp']}/{p['max_hp']} HP)"
-                                     for p in game_state['pokemon_team']])
-                prompt_parts.append(f"- Team: {team_str}")
-            if game_state.get("badges"):
-                prompt_parts.append(f"- Badges: {game_state['badges']}/8")
-            if game_state.get("money"):
-                prompt_parts.append(f"- Money: ${game_state['money']}")
+            # Falsy values are left out
+            for key, format_line in PROMPT_FIELDS:
+                if value := game_state.get(key):
+                    prompt_parts.append(format_line(value))
 
         if recent_actions:
             actions_str = " -> ".join(recent_actions[-10:])
@@ -202,6 +552,22 @@ Only output the JSON, nothing else."""
 
         return "\n".join(prompt_parts)
 
+    def _decision_from_data(self, data):
+        """Validate a decoded action object and fill in defaults."""
+        action = data.get("action", "a").lower()
+        if action not in VALID_ACTIONS:
+            action = "a"
+
+        commentary = data.get("commentary", "Deciding next action...")
+        confidence = float(data.get("confidence", 0.5))
+        confidence = max(0.0, min(1.0, confidence))
+
+        return {
+            "action": action,
+            "commentary": commentary,
+            "confidence": confidence
+        }
+
     def _parse_response(self, response_text):
         """Parse the API response into action details."""
         try:
@@ -210,52 +576,29 @@ Only output the JSON, nothing else."""
             response_text = response_text.strip()
 
             # Try to find JSON in the response
-            if response_text.startswith('{'):
-                json_str = response_text
-            else:
-                # Try to find JSON block
-                import re
-                json_match = re.search(r'\{[^{}]*\}', response_text)
-                if json_match:
-                    json_str = json_match.group()
-                else:
-                    raise ValueError("No JSON found in response")
-
-            data = json.loads(json_str)
-
-            # Validate and extract fields
-            action = data.get("action", "a").lower()
-            valid_actions = ["a", "b", "up", "down", "left", "right", "start", "select"]
-            if action not in valid_actions:
-                action = "a"
-
-            commentary = data.get("commentary", "Deciding next action...")
-            confidence = float(data.get("confidence", 0.5))
-            confidence = max(0.0, min(1.0, confidence))
+            json_str = extract_json_object(response_text)
+            if json_str is None:
+                raise ValueError("No JSON found in response")
 
-            return {
-                "action": action,
-                "commentary": commentary,
-                "confidence": confidence
-            }
+            return self._decision_from_data(json_loads(json_str))
 
         except Exception as e:
-            logger.warning(f"Failed to parse API response: {e}")
-            logger.debug(f"Raw response: {response_text}")
+            logger.warning("Failed to parse API response: %s", e)
+            logger.debug("Raw response: %s", response_text)
 
             # Try to extract just the action from common response patterns
             response_lower = response_text.lower()
-            for action in ["up", "down", "left", "right", "start", "select"]:
-                if action in response_lower:
-                    return {
-                        "action": action,
-                        "commentary": "Parsed from text response",
-                        "confidence": 0.3
-                    }
+            action_match = ACTION_WORD_RE.search(response_lower)
+            if action_match:
+                return {
+                    "action": action_match.group(1),
+                    "commentary": "Parsed from text response",
+                    "confidence": 0.3
+                }
 
             # Default to 'a' if we can't parse
             return {
-                "action": "a" if "a" in response_lower else "b",
+                "action": "a",
                 "commentary": "Could not parse response, guessing action",
                 "confidence": 0.1
             }
@@ -280,26 +623,20 @@ Only output the JSON, nothing else."""
                 "suggested_context": None
             }
 
-        image_base64 = self.encode_image(screenshot)
+        image_url = self.image_data_url(screenshot)
+
+        # An identical frame gets the same analysis without a round trip
+        cached = self._cached_analysis(image_url)
+        if cached is not None:
+            return cached
 
         try:
-            response = self.client.chat.completions.create(
+            response_text = self._stream_reply(
                 model=self.model,
                 messages=[
                     {
                         "role": "system",
-                        "content": """Analyze this Pokemon game screenshot and identify:
-1. The screen type (battle, overworld, menu, dialogue, title, pokemon_center, pokemart, cave, building, route)
-2. Brief description of what's happening
-3. Any important details (enemy Pokemon, menu options, NPC text, etc.)
-
-Respond with JSON only:
-{
-    "screen_type": "type",
-    "description": "brief description",
-    "details": "important details",
-    "suggested_context": "context for next action"
-}"""
+                        "content": self._build_analysis_prompt()
                     },
                     {
                         "role": "user",
@@ -311,28 +648,27 @@ Respond with JSON only:
                             {
                                 "type": "image_url",
                                 "image_url": {
-                                    "url": f"data:image/png;base64,{image_base64}"
+                                    "url": image_url
                                 }
                             }
                         ]
                     }
                 ],
-                max_tokens=300,
-                temperature=0.3
+                max_tokens=120,
+                temperature=0.3,
+                response_format={"type": "json_object"}
             )
 
-            response_text = response.choices[0].message.content.strip()
+            response_text = response_text.strip()
 
-            try:
-                if response_text.startswith('{'):
-                    return json.loads(response_text)
-                else:
-                    import re
-                    json_match = re.search(r'\{[^{}]*\}', response_text)
-                    if json_match:
-                        return json.loads(json_match.group())
-            except:
-                pass
+            json_str = extract_json_object(response_text)
+            if json_str is not None:
+                try:
+                    analysis = json_loads(json_str)
+                    self._remember_analysis(image_url, analysis)
+                    return analysis
+                except ValueError:
+                    pass
 
             return {
                 "screen_type": "unknown",
@@ -341,13 +677,122 @@ Respond with JSON only:
             }
 
         except Exception as e:
-            logger.error(f"Error analyzing screen: {e}")
+            logger.error("Error analyzing screen: %s", e)
+            return {
+                "screen_type": "unknown",
+                "description": f"Error: {str(e)[:100]}",
+                "suggested_context": None
+            }
+
+    def _cached_analysis(self, image_url):
+        """Return a copy of the remembered analysis if it is for this frame and fresh."""
+        if (image_url == self._last_analysis_url
+                and time.monotonic() - self._last_analysis_time < ANALYSIS_CACHE_SECONDS):
+            return dict(self._last_analysis)
+        return None
+
+    def _remember_analysis(self, image_url, analysis):
+        """Keep a parsed analysis for analyze_screen to return for the same frame."""
+        self._last_analysis = dict(analysis)
+        self._last_analysis_url = image_url
+        self._last_analysis_time = time.monotonic()
+
+    def get_action_and_analysis(self, screenshot, game_state, recent_actions=None, context=None):
+        """
+        Get the next action and a screen analysis from a single API call.
+
+        The screenshot is uploaded once and only one round trip is paid,
+        instead of calling analyze_screen and get_game_action separately.
+
+        Args:
+            screenshot: PIL Image of the current game screen
+            game_state: Dictionary containing game state information
+            recent_actions: List of recent actions taken
+            context: Additional context about the current situation
+
+        Returns:
+            Tuple of (decision, analysis) shaped like the results of
+            get_game_action and analyze_screen
+        """
+        if not self.is_available():
+            return self.get_game_action(screenshot, game_state, recent_actions, context), {
+                "screen_type": "unknown",
+                "description": "API not available",
+                "suggested_context": None
+            }
+
+        image_url = self.image_data_url(screenshot)
+
+        # Frame already analyzed: only the action is needed, which is the
+        # smaller request
+        cached = self._cached_analysis(image_url)
+        if cached is not None:
+            return self.get_game_action(screenshot, game_state, recent_actions, context), cached
+
+        user_prompt = self._build_user_prompt(game_state, recent_actions, context)
+
+        try:
+            response_text = self._stream_reply(
+                model=self.model,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": self._build_combined_prompt()
+                    },
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "text",
+                                "text": user_prompt
+                            },
+                            {
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": image_url
+                                }
+                            }
+                        ]
+                    }
+                ],
+                max_tokens=200,
+                temperature=0.2,
+                response_format={"type": "json_object"}
+            )
+            response_text = response_text.strip()
+
+        except Exception as e:
+            logger.error("Error calling xAI API: %s", e)
             return {
+                "action": "a",
+                "commentary": f"API error: {str(e)[:100]}",
+                "confidence": 0.0
+            }, {
                 "screen_type": "unknown",
                 "description": f"Error: {str(e)[:100]}",
                 "suggested_context": None
             }
 
+        try:
+            json_str = extract_json_object(response_text)
+            if json_str is None:
+                raise ValueError("No JSON found in response")
+            data = json_loads(json_str)
+            decision = self._decision_from_data(data["decision"])
+            analysis = data.get("analysis")
+            if isinstance(analysis, dict):
+                self._remember_analysis(image_url, analysis)
+                return decision, analysis
+        except Exception as e:
+            logger.warning("Failed to parse combined API response: %s", e)
+            decision = self._parse_response(response_text)
+
+        return decision, {
+            "screen_type": "unknown",
+            "description": response_text[:200],
+            "suggested_context": None
+        }
+
 
 # Singleton instance for easy access
 _client_instance = None
@@ -355,19 +800,22 @@ _client_instance = None
 def get_xai_client(api_key=None):
     """Get or create the xAI client singleton."""
     global _client_instance
-    if _client_instance is None or api_key is not None:
+    # Only an explicitly different key replaces the client, so its HTTP
+    # connection pool survives repeated calls
+    if _client_instance is None or (api_key is not None and api_key != _client_instance.api_key):
         _client_instance = XAIClient(api_key)
     return _client_instance
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
     # Test the client
     client = get_xai_client()
     print(f"xAI client available: {client.is_available()}")
 
     if client.is_available():
         # Create a test image
-        from PIL import Image
         test_image = Image.new('RGB', (160, 144), color='white')
 
         result = client.get_game_action(